@@ -8,16 +8,24 @@ import uuid
 
 from msrest.authentication import CognitiveServicesCredentials
 
+from ofurufu.blob import authenticate_blob_client
 from ofurufu.face_recognition import authenticate_face_client
 from ofurufu.face_recognition import create_person_group
 from ofurufu.face_recognition import detect_faces
+from ofurufu.face_recognition import detect_faces_batch
 from ofurufu.face_recognition import draw_bbox
 from ofurufu.face_recognition import match_against_person_group
 from ofurufu.face_recognition import verify_face
+from ofurufu.scheduler import run
 from ofurufu.variables import Variables
+from ofurufu.video_analyzer import INDEXING_PRESETS
 from ofurufu.video_analyzer import authenticate_video_indexer
 from ofurufu.video_analyzer import get_sentiment_and_emotion
+from ofurufu.video_analyzer import get_video_insights
 from ofurufu.video_analyzer import save_face_thumbnails
+from ofurufu.video_analyzer import upload_video
+from ofurufu.video_analyzer import upload_video_from_blob
+from ofurufu.video_analyzer import wait_for_index
 
 
 logging.basicConfig(
@@ -40,6 +48,11 @@ def get_parser():
     parser.add_argument("--video-language", default="English")
     parser.add_argument("--video-path")
     parser.add_argument("--video-id")
+    parser.add_argument("--index-timeout", type=float, default=900, help="Seconds to wait for indexing")
+    parser.add_argument("--indexing-preset", choices=INDEXING_PRESETS, default="Default")
+    parser.add_argument(
+        "--container", help="Stage the video in this blob container and index it by URL instead of uploading it"
+    )
     parser.add_argument("--person-group-id", default=str(uuid.uuid4()))
     parser.add_argument("--person-group-name")
     parser.add_argument("--create-person-group", action="store_true")
@@ -55,6 +68,7 @@ def get_parser():
 def main():
     args = get_parser()
     uploaded_video_id = args.video_id
+    video_info = None
 
     indexer = authenticate_video_indexer(
         v.VIDEO_ANALYZER_SUBSCRIPTION_KEY,
@@ -69,18 +83,29 @@ def main():
 
     if args.upload_video:
         logger.info(f"Uploading video: {args.video_path} to indexer")
-        uploaded_video_id = indexer.upload_video_to_indexer(
-            input_filename=args.video_path,
-            video_name=args.video_name,
-            video_language=args.video_language
+        upload_kwargs = {
+            "video_name": args.video_name,
+            "video_language": args.video_language,
+            "indexing_preset": args.indexing_preset
+        }
+        if args.container:
+            blob_client = authenticate_blob_client(v.BLOB_ACCOUNT_NAME, v.BLOB_ACCOUNT_KEY)
+            uploaded_video_id = upload_video_from_blob(
+                indexer, blob_client, args.container, args.video_path, **upload_kwargs
+            )
+        else:
+            uploaded_video_id = upload_video(indexer, video_path=args.video_path, **upload_kwargs)
+        video_info = run(
+            wait_for_index(indexer, uploaded_video_id, args.video_language, timeout=args.index_timeout)
         )
-        time.sleep(300) # NOTE: Hack to allow indexing
 
     person_images = glob.glob(f"{args.thumbnail_dir}/*.jpg")
 
     if args.get_video_info:
         logger.info(f"Analyzing video with id: {uploaded_video_id}")
-        video_info = indexer.get_video_info(uploaded_video_id, video_language=args.video_language)
+        video_info = video_info or get_video_insights(
+            indexer, uploaded_video_id, video_language=args.video_language
+        )
         logger.info(video_info)
         
         insights = get_sentiment_and_emotion(video_info)
@@ -112,15 +137,21 @@ def main():
         logger.info(f"Created person group: {args.person_group_id}")
 
     if args.identity_cards:
-        faces_in_ids = detect_faces(face_client, args.identity_cards)
+        faces_in_ids = detect_faces_batch(face_client, args.identity_cards)
         
-        for image, face_id in faces_in_ids.items():
+        for image, faces in faces_in_ids.items():
+            if not faces:
+                logger.warning(f"No face found in identity card: {image}")
+                continue
+            face_id = faces[0].face_id
             is_identical, confidence = verify_face(
                 face_client, face_id, list(person_group_faces.values())[1]
             )
             if is_identical:
                 logger.info(f"Person matched with confidence: {confidence}")
-                # draw_bbox(image, faces_in_ids)
+                # Identity cards given as URLs were never downloaded, so only local ones are drawn on
+                if os.path.isfile(image):
+                    draw_bbox(image, faces)
 
             match_against_person_group(face_client, [face_id], args.person_group_id)
 
@@ -1,35 +1,391 @@
+import argparse
+import hashlib
+import logging
+import mimetypes
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
 
+from azure.storage.blob import BlobSasPermissions
 from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import ContentSettings
+from azure.storage.blob import generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+
+from ofurufu.cache import CACHE_DIR
+from ofurufu.cache import DiskCache
+from ofurufu.cache import content_hash
+from ofurufu.throttling import throttled_call
+from ofurufu.throttling import throttled_call_async
+from ofurufu.variables import Variables
+
+v = Variables()
+
+logging.basicConfig(
+    filename=f"logs/ofurufu_{time.time()}.log",
+    format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
 
 CONNECTION_STRING_FORMAT = "DefaultEndpointsProtocol=https;AccountName={account_name};" \
                            "AccountKey={account_key};EndpointSuffix=core.windows.net"
 
+# Blocks transferred at the same time for a single blob
+DEFAULT_MAX_CONCURRENCY = 4
+# Size of each block uploaded or range downloaded. Smaller blobs are sent in one request
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Lifetime of the read-only URLs handed to the Azure services. Video Indexer and Form Recognizer
+# fetch the blob when the request is made, so the URL only has to outlive the request
+SAS_EXPIRY = timedelta(hours=1)
+
+# ETags of the blobs last transferred by `sync_directory`, for blobs without a Content-MD5
+TRANSFER_CACHE = DiskCache(os.path.join(CACHE_DIR, "blob_transfers"))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser("CLI for syncing a local directory with a blob container")
+    parser.add_argument("--container", required=True)
+    parser.add_argument("--local-dir", required=True)
+    parser.add_argument("--prefix", default="", help="Blob name prefix mirrored by `local-dir`")
+    parser.add_argument(
+        "--download", action="store_true", help="Download the container to `local-dir` instead of uploading"
+    )
+    parser.add_argument("--max-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument(
+        "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Block size of transfers in bytes"
+    )
+    parser.add_argument("--max-workers", type=int, default=8, help="Number of files transferred at the same time")
+    args = parser.parse_args()
+
+    if args.max_concurrency < 1 or args.max_workers < 1:
+        raise ValueError("`max-concurrency` and `max-workers` must be at least 1")
+    return args
 
-def authenticate_blob_client(account_name: str, account_key: str) -> BlobServiceClient:
+
+def _chunk_settings(chunk_size: int) -> dict:
+    return {
+        "max_block_size": chunk_size,
+        "max_single_put_size": chunk_size,
+        "max_chunk_get_size": chunk_size,
+        "max_single_get_size": chunk_size,
+    }
+
+
+def authenticate_blob_client(
+        account_name: str, account_key: str, chunk_size: int = DEFAULT_CHUNK_SIZE, **kwargs
+) -> BlobServiceClient:
+    """
+    :param chunk_size: Bytes per block when uploading and per range when downloading
+    """
     return BlobServiceClient.from_connection_string(
         CONNECTION_STRING_FORMAT.format(
             account_name=account_name,
             account_key=account_key
-        )
+        ),
+        **{**_chunk_settings(chunk_size), **kwargs}
+    )
+
+
+def authenticate_blob_client_async(
+        account_name: str, account_key: str, chunk_size: int = DEFAULT_CHUNK_SIZE, **kwargs
+) -> AsyncBlobServiceClient:
+    """Blob client for use with `asyncio`. Close it with `await client.close()`"""
+    return AsyncBlobServiceClient.from_connection_string(
+        CONNECTION_STRING_FORMAT.format(
+            account_name=account_name,
+            account_key=account_key
+        ),
+        **{**_chunk_settings(chunk_size), **kwargs}
     )
 
 
-def upload_blob(file_path: str, container: str, client: BlobServiceClient, dest_path: str = None):
+def file_md5(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> bytes:
+    """MD5 digest of a file's content, read in chunks"""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _content_settings(file_path: str) -> ContentSettings:
+    # Blobs uploaded in blocks get no Content-MD5 from the service, so it is set here
+    # for `sync_directory` to detect unchanged files
+    return ContentSettings(
+        content_type=mimetypes.guess_type(file_path)[0],
+        content_md5=bytearray(file_md5(file_path))
+    )
+
+
+def upload_blob(
+        file_path: str,
+        container: str,
+        client: BlobServiceClient,
+        dest_path: str = None,
+        overwrite: bool = False,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+):
+    """
+    Stream a file to a blob in blocks, `max_concurrency` of them in parallel
+
+    :param overwrite: Replace the blob if it exists. Otherwise, an existing blob raises `ResourceExistsError`
+    """
     dest_path = dest_path or os.path.split(file_path)[1]
     blob_client = client.get_blob_client(
         container=container,
         blob=dest_path
     )
-    with open(file_path, "rb") as data:
-        blob_client.upload_blob(data)
 
+    def upload():
+        with open(file_path, "rb") as data:
+            return blob_client.upload_blob(
+                data,
+                overwrite=overwrite,
+                max_concurrency=max_concurrency,
+                content_settings=_content_settings(file_path)
+            )
+
+    throttled_call("blob", upload)
     return blob_client.url
 
 
-def download_blob(client: BlobServiceClient, container: str, filename: str, download_dir: str):
+def download_blob(
+        client: BlobServiceClient,
+        container: str,
+        filename: str,
+        download_dir: str,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+):
+    """Stream a blob to `download_dir` in ranges, `max_concurrency` of them in parallel"""
     blob_client = client.get_blob_client(container, filename)
 
     path = os.path.join(download_dir, filename)
-    with open(path, "wb") as download_file:
-        download_file.write(blob_client.download_blob().readall())
\ No newline at end of file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def download():
+        with open(path, "wb") as download_file:
+            return blob_client.download_blob(max_concurrency=max_concurrency).readinto(download_file)
+
+    throttled_call("blob", download)
+    return path
+
+
+async def upload_blob_async(
+        file_path: str,
+        container: str,
+        client: AsyncBlobServiceClient,
+        dest_path: str = None,
+        overwrite: bool = False,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+):
+    dest_path = dest_path or os.path.split(file_path)[1]
+    blob_client = client.get_blob_client(
+        container=container,
+        blob=dest_path
+    )
+
+    async def upload():
+        with open(file_path, "rb") as data:
+            return await blob_client.upload_blob(
+                data,
+                overwrite=overwrite,
+                max_concurrency=max_concurrency,
+                content_settings=_content_settings(file_path)
+            )
+
+    await throttled_call_async("blob", upload)
+    return blob_client.url
+
+
+async def download_blob_async(
+        client: AsyncBlobServiceClient,
+        container: str,
+        filename: str,
+        download_dir: str,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+):
+    blob_client = client.get_blob_client(container, filename)
+
+    path = os.path.join(download_dir, filename)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    async def download():
+        stream = await blob_client.download_blob(max_concurrency=max_concurrency)
+        with open(path, "wb") as download_file:
+            return await stream.readinto(download_file)
+
+    await throttled_call_async("blob", download)
+    return path
+
+
+def get_blob_url(
+        client: BlobServiceClient, container: str, blob_name: str, expiry: timedelta = SAS_EXPIRY
+) -> str:
+    """URL of a blob with a read-only SAS token valid for `expiry`"""
+    sas_token = generate_blob_sas(
+        account_name=client.account_name,
+        container_name=container,
+        blob_name=blob_name,
+        account_key=client.credential.account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.utcnow() + expiry
+    )
+    return f"{client.get_blob_client(container, blob_name).url}?{sas_token}"
+
+
+def get_blob_content_key(client: BlobServiceClient, container: str, blob_name: str) -> str:
+    """
+    Identifies the content of a blob without downloading it: its Content-MD5,
+    or its ETag when it was uploaded without one
+    """
+    blob_client = client.get_blob_client(container, blob_name)
+    properties = throttled_call("blob", blob_client.get_blob_properties)
+    content_md5 = properties.content_settings.content_md5
+    if content_md5:
+        return f"md5:{bytes(content_md5).hex()}"
+    return f"etag:{properties.etag}"
+
+
+def get_blob_document(
+        client: BlobServiceClient, container: str, blob_name: str, expiry: timedelta = SAS_EXPIRY
+) -> tuple:
+    """
+    :return: `(url, content_key)`, a read-only SAS URL of the blob and the key its results are cached by
+    """
+    return get_blob_url(client, container, blob_name, expiry), get_blob_content_key(client, container, blob_name)
+
+
+def _transfer_key(container: str, blob_name: str, path: str) -> str:
+    return content_hash(container, blob_name, os.path.abspath(path))
+
+
+def _local_state(path: str):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def _is_unchanged(container: str, blob_name: str, path: str, properties, cache: DiskCache) -> bool:
+    """
+    Compare a local file with a blob by MD5 when the blob has one. Otherwise, by the ETag
+    recorded when the file was last transferred, as long as the file has not changed since
+    """
+    if properties is None or not os.path.exists(path):
+        return False
+
+    remote_md5 = properties.content_settings.content_md5
+    if remote_md5:
+        return bytes(remote_md5) == file_md5(path)
+
+    record = cache.get(_transfer_key(container, blob_name, path)) if cache is not None else None
+    return record is not None and record == (properties.etag, _local_state(path))
+
+
+def sync_directory(
+        client: BlobServiceClient,
+        container: str,
+        local_dir: str,
+        prefix: str = "",
+        download: bool = False,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_workers: int = 8,
+        cache: DiskCache = TRANSFER_CACHE
+) -> list:
+    """
+    Mirror `local_dir` to the blobs under `prefix`, or the blobs to `local_dir` when `download`.
+    Files whose content matches the other side are skipped.
+
+    :param max_concurrency: Blocks transferred in parallel for each file
+    :param max_workers: Files transferred at the same time
+    :return: Names of the blobs that were transferred
+    """
+    container_client = client.get_container_client(container)
+    remote = {
+        properties.name: properties
+        for properties in throttled_call("blob", lambda: list(container_client.list_blobs(name_starts_with=prefix)))
+    }
+
+    if download:
+        pairs = []
+        local_root = os.path.abspath(local_dir)
+        for name in remote:
+            if name.endswith("/"):
+                continue
+            path = os.path.abspath(os.path.join(local_root, *name[len(prefix):].lstrip("/").split("/")))
+            # Blob names are chosen by whoever can write to the container. Names such as `../x` must not
+            # write outside `local_dir`
+            if path == local_root or os.path.commonpath([local_root, path]) != local_root:
+                logger.warning(f"Skipping blob {name} that would be downloaded outside {local_dir}: {path}")
+                continue
+            pairs.append((name, path))
+    else:
+        pairs = []
+        for root, _, files in os.walk(local_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                relative_path = os.path.relpath(path, local_dir).replace(os.sep, "/")
+                name = f"{prefix.rstrip('/')}/{relative_path}" if prefix else relative_path
+                pairs.append((name, path))
+
+    def transfer(name, path):
+        if _is_unchanged(container, name, path, remote.get(name), cache):
+            logger.info(f"Skipping unchanged {name}")
+            return None
+
+        blob_client = container_client.get_blob_client(name)
+        if download:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+            def download_to_file():
+                with open(path, "wb") as f:
+                    stream = blob_client.download_blob(max_concurrency=max_concurrency)
+                    stream.readinto(f)
+                    return stream.properties.etag
+
+            etag = throttled_call("blob", download_to_file)
+        else:
+            def upload_from_file():
+                with open(path, "rb") as data:
+                    return blob_client.upload_blob(
+                        data,
+                        overwrite=True,
+                        max_concurrency=max_concurrency,
+                        content_settings=_content_settings(path)
+                    )["etag"]
+
+            etag = throttled_call("blob", upload_from_file)
+
+        if cache is not None:
+            cache.set(_transfer_key(container, name, path), (etag, _local_state(path)))
+        logger.info(f"{'Downloaded' if download else 'Uploaded'} {name}")
+        return name
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        transferred = list(executor.map(lambda pair: transfer(*pair), pairs))
+
+    transferred = [name for name in transferred if name is not None]
+    logger.info(f"Transferred {len(transferred)} of {len(pairs)} files")
+    return transferred
+
+
+def main():
+    args = get_parser()
+    client = authenticate_blob_client(v.BLOB_ACCOUNT_NAME, v.BLOB_ACCOUNT_KEY, chunk_size=args.chunk_size)
+    transferred = sync_directory(
+        client,
+        args.container,
+        args.local_dir,
+        prefix=args.prefix,
+        download=args.download,
+        max_concurrency=args.max_concurrency,
+        max_workers=args.max_workers
+    )
+    print(f"Transferred {len(transferred)} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from typing import Any
+from typing import Union
+
+logging.basicConfig(
+    filename=f"logs/ofurufu_{time.time()}.log",
+    format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "cache"
+_MISSING = object()
+
+
+def content_hash(*parts: Union[bytes, str]) -> str:
+    """
+    SHA-256 over `parts`. Parts are length-prefixed so that different splits of the
+    same bytes do not collide.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def file_hash(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file's content, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Persistent key-value cache with one pickle file per entry.
+
+    Entries older than `ttl` seconds are dropped when read. Once the cache grows past
+    `max_size` bytes, least recently used entries are removed. Writes are atomic, so
+    the cache can be shared by threads and by separate runs.
+
+    :param directory: Directory holding the entries. Created on first write
+    :param ttl: Seconds an entry stays valid. `None` keeps entries until evicted for size
+    :param max_size: Maximum total size of the entries in bytes. `None` means unbounded
+    """
+    def __init__(self, directory: str, ttl: float = None, max_size: int = None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if self.ttl is not None and time.time() - stat.st_mtime > self.ttl:
+                self.delete(key)
+                return default
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        except (AttributeError, ImportError) as e:
+            # The entry was pickled by a version of the code whose classes have since moved or changed
+            logger.warning(f"Ignoring cache entry that can no longer be unpickled: {path}: {e!r}")
+            return default
+
+        # The modification time records when the entry was written and drives expiry.
+        # The access time is set explicitly (mounts may not track it) and drives LRU eviction
+        try:
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            pass
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Store `value` under `key`. A value that cannot be written, say to a full disk or because it
+        cannot be pickled, is logged and left uncached rather than failing the call that produced it
+        """
+        tmp_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f)
+            os.replace(tmp_path, self._path(key))
+        except Exception as e:
+            logger.warning(f"Could not write cache entry {key} to {self.directory}: {e!r}")
+            if tmp_path is not None:
+                _remove(tmp_path)
+            return
+
+        if self.max_size is not None:
+            self.evict()
+
+    def delete(self, key: str) -> None:
+        _remove(self._path(key))
+
+    def evict(self) -> None:
+        """Remove expired entries, then least recently used entries until under `max_size`"""
+        with self._lock:
+            entries = []
+            now = time.time()
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".pkl"):
+                    continue
+                stat = entry.stat()
+                if self.ttl is not None and now - stat.st_mtime > self.ttl:
+                    _remove(entry.path)
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+
+            total_size = sum(size for _, size, _ in entries)
+            if self.max_size is None or total_size <= self.max_size:
+                return
+
+            for _, size, path in sorted(entries):
+                _remove(path)
+                total_size -= size
+                if total_size <= self.max_size:
+                    break
+            logger.info(f"Evicted cache entries in {self.directory} down to {total_size} bytes")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
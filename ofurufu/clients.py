@@ -0,0 +1,143 @@
+"""
+Process-wide registry of Azure clients.
+
+Each client is created on first use and then shared by every thread and coroutine.
+Clients built on azure-core (Form Recognizer, Blob Storage) share one pooled HTTP session,
+and msrest clients (Face, Custom Vision) keep their sessions alive between requests,
+so connections and TLS handshakes are reused across documents.
+
+Async clients are bound to the event loop that created them, so they are kept apart from the
+thread-safe clients and closed with `close_async_clients` before their loop stops.
+"""
+import threading
+
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from msrest.authentication import CognitiveServicesCredentials
+from requests.adapters import HTTPAdapter
+
+from ofurufu.blob import authenticate_blob_client
+from ofurufu.blob import authenticate_blob_client_async
+from ofurufu.face_recognition import authenticate_face_client
+from ofurufu.form_recognizer import authenticate_form_client
+from ofurufu.form_recognizer import authenticate_form_client_async
+from ofurufu.lighter_detector import ONNX_MODEL_PATH
+from ofurufu.lighter_detector import authenticate as authenticate_custom_vision
+from ofurufu.lighter_detector import load_local_detector
+from ofurufu.variables import Variables
+from ofurufu.video_analyzer import authenticate_video_indexer
+
+v = Variables()
+
+CONNECTION_POOL_SIZE = 32
+
+_clients = {}
+_locks = {}
+_registry_lock = threading.Lock()
+_async_clients = {}
+
+
+def _get_or_create(name: str, factory):
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _registry_lock:
+        lock = _locks.setdefault(name, threading.Lock())
+
+    with lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def get_session(pool_size: int = CONNECTION_POOL_SIZE) -> requests.Session:
+    """
+    Shared HTTP session with keep-alive. `pool_size` connections are kept per host.
+    Only the first call sets the pool size.
+    """
+    def create():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    return _get_or_create("session", create)
+
+
+def _transport() -> RequestsTransport:
+    return RequestsTransport(session=get_session(), session_owner=False)
+
+
+def get_form_client():
+    return _get_or_create(
+        "form_recognizer",
+        lambda: authenticate_form_client(
+            v.FORM_RECOGNIZER_ENDPOINT, v.FORM_RECOGNIZER_KEY, training=False, transport=_transport()
+        )
+    )
+
+
+def get_face_client():
+    def create():
+        client = authenticate_face_client(
+            v.FACE_RECOGNIZER_ENDPOINT, CognitiveServicesCredentials(v.FACE_RECOGNIZER_SUBSCRIPTION_KEY)
+        )
+        client.config.keep_alive = True
+        return client
+
+    return _get_or_create("face", create)
+
+
+def get_prediction_client():
+    def create():
+        client = authenticate_custom_vision(v.CUSTOM_VISION_PREDICTION_KEY, training=False)
+        client.config.keep_alive = True
+        return client
+
+    return _get_or_create("custom_vision_prediction", create)
+
+
+def get_local_lighter_detector(model_path: str = ONNX_MODEL_PATH):
+    """ONNX lighter detector, loaded once per model. `None` if it cannot be loaded"""
+    return _get_or_create(f"onnx_lighter_detector:{model_path}", lambda: load_local_detector(model_path))
+
+
+def get_indexer():
+    return _get_or_create(
+        "video_indexer",
+        lambda: authenticate_video_indexer(
+            v.VIDEO_ANALYZER_SUBSCRIPTION_KEY, v.VIDEO_ANALYZER_LOCATION, v.VIDEO_ANALYZER_ACCOUNT_ID
+        )
+    )
+
+
+def get_blob_service_client():
+    return _get_or_create(
+        "blob",
+        lambda: authenticate_blob_client(v.BLOB_ACCOUNT_NAME, v.BLOB_ACCOUNT_KEY, transport=_transport())
+    )
+
+
+def get_form_client_async():
+    """Async Form Recognizer client of the running event loop"""
+    if "form_recognizer" not in _async_clients:
+        _async_clients["form_recognizer"] = authenticate_form_client_async(
+            v.FORM_RECOGNIZER_ENDPOINT, v.FORM_RECOGNIZER_KEY
+        )
+    return _async_clients["form_recognizer"]
+
+
+def get_blob_service_client_async():
+    """Async Blob Storage client of the running event loop"""
+    if "blob" not in _async_clients:
+        _async_clients["blob"] = authenticate_blob_client_async(v.BLOB_ACCOUNT_NAME, v.BLOB_ACCOUNT_KEY)
+    return _async_clients["blob"]
+
+
+async def close_async_clients():
+    """Close the async clients and their connections. Call before the event loop stops"""
+    while _async_clients:
+        _, client = _async_clients.popitem()
+        await client.close()
@@ -1,14 +1,30 @@
+import asyncio
+import io
 import logging
 import os
+import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterable
 
 from azure.cognitiveservices.vision.face import FaceClient
 from azure.cognitiveservices.vision.face.models import TrainingStatusType
 from PIL import Image
 from PIL import ImageDraw
 
+from ofurufu.cache import CACHE_DIR
+from ofurufu.cache import DiskCache
+from ofurufu.cache import content_hash
+from ofurufu.cache import file_hash
+from ofurufu.preprocessing import open_image
+from ofurufu.preprocessing import preprocess_image
+from ofurufu.preprocessing import rescale_face_rectangle
+from ofurufu.scheduler import map_bounded
+from ofurufu.scheduler import run_blocking
+from ofurufu.throttling import throttled_call
 from ofurufu.variables import Variables
 
 logging.basicConfig(
@@ -21,6 +37,14 @@ logger = logging.getLogger(__name__)
 
 v = Variables()
 
+# Face ids returned by detection expire 24 hours after they are created
+FACE_ID_LIFETIME = 24 * 60 * 60
+# Cached face ids closer than this to expiry are detected again
+FACE_ID_EXPIRY_MARGIN = 60 * 60
+FACE_ID_CACHE = DiskCache(os.path.join(CACHE_DIR, "face_ids"), ttl=FACE_ID_LIFETIME)
+# Seconds a passenger waits for the LargePersonGroup to be trained with their faces
+TRAINING_TIMEOUT = 10 * 60
+
 
 def authenticate_face_client(endpoint, credentials):
     client = FaceClient(endpoint, credentials)
@@ -30,18 +54,21 @@ def authenticate_face_client(endpoint, credentials):
 
 
 def create_person_group(client: FaceClient, person_group_id: str, person_group_name: str, images: list = None):
-    client.person_group.create(person_group_id=person_group_id, name=person_group_id)
+    throttled_call("face", client.person_group.create, person_group_id=person_group_id, name=person_group_id)
     
-    person = client.person_group_person.create(person_group_id, person_group_name)
+    person = throttled_call("face", client.person_group_person.create, person_group_id, person_group_name)
 
-    for image in images:
-        with open(image, "rb") as f:
+    def add_face(image):
+        with open_image(image, "face") as f:
             client.person_group_person.add_face_from_stream(person_group_id, person.person_id, f)
 
-    client.person_group.train(person_group_id)
+    for image in images:
+        throttled_call("face", add_face, image)
+
+    throttled_call("face", client.person_group.train, person_group_id)
 
     while True:
-        training_status = client.person_group.get_training_status(person_group_id)
+        training_status = throttled_call("face", client.person_group.get_training_status, person_group_id)
         if training_status.status is TrainingStatusType.succeeded:
             break
         elif training_status.status is TrainingStatusType.failed:
@@ -52,49 +79,395 @@ def create_person_group(client: FaceClient, person_group_id: str, person_group_n
         time.sleep(10)
 
 
-def detect_faces(client: FaceClient, image_list: list):
-    face_ids = {}
-    for image_path in image_list:
-        image = open(image_path, "rb")
+class FlightIdentityIndex:
+    """
+    A single LargePersonGroup for all the passengers of a flight.
+
+    Each passenger is added as a person, with their face images added in parallel.
+    Training runs in a background thread and is repeated whenever passengers are added
+    while it runs, so identification only waits for the round that includes its person.
+    A round that fails only fails the passengers waiting on it: the next passenger added
+    starts another round. The group is deleted when the index is closed.
+
+    :param flight_id: Used to derive the id of the LargePersonGroup
+    :param max_workers: Number of faces added at the same time
+    :param poll_interval: Seconds between checks of the training status
+    :param training_timeout: Seconds a round of training may take before it is given up as failed
+    """
+    def __init__(
+            self,
+            client: FaceClient,
+            flight_id: str,
+            max_workers: int = 4,
+            poll_interval: float = 2,
+            training_timeout: float = TRAINING_TIMEOUT
+    ):
+        self.client = client
+        self.group_id = re.sub(r"[^a-z0-9_-]", "-", f"{flight_id}-{time.strftime('%Y%m%d-%H%M%S')}".lower())[:64]
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.training_timeout = training_timeout
+
+        self._condition = threading.Condition()
+        self._version = 0
+        self._trained_version = 0
+        # Latest version whose round of training failed, and why
+        self._failed_version = 0
+        self._training_error = None
+        self._closed = False
+        self._trainer = None
+
+    def create(self):
+        throttled_call(
+            "face", self.client.large_person_group.create, large_person_group_id=self.group_id, name=self.group_id
+        )
+        self._trainer = threading.Thread(target=self._train_forever, daemon=True)
+        self._trainer.start()
+        logger.info(f"Created LargePersonGroup: {self.group_id}")
+        return self
+
+    def __enter__(self):
+        return self.create()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_person(self, name: str, images: list) -> tuple:
+        """
+        Add a person with the faces in `images`, local paths or the bytes of images, and schedule training.
+
+        :return: `(person_id, version)`. Pass `version` to `wait_until_trained`
+        """
+        person = throttled_call("face", self.client.large_person_group_person.create, self.group_id, name)
+
+        def add_face(image):
+            with open_image(image, "face") as f:
+                self.client.large_person_group_person.add_face_from_stream(self.group_id, person.person_id, f)
+
+        def add_face_throttled(image):
+            throttled_call("face", add_face, image)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            list(pool.map(add_face_throttled, images))
+        logger.info(f"Added person: {name} with {len(images)} faces to LargePersonGroup: {self.group_id}")
+
+        with self._condition:
+            self._version += 1
+            self._condition.notify_all()
+            return person.person_id, self._version
+
+    def wait_until_trained(self, version: int, timeout: float = None):
+        with self._condition:
+            trained = self._condition.wait_for(
+                lambda: self._trained_version >= version or self._failed_version >= version or self._closed, timeout
+            )
+            if self._trained_version >= version:
+                return
+            if self._failed_version >= version:
+                raise RuntimeError(self._training_error)
+            if self._closed:
+                raise RuntimeError(f"LargePersonGroup: {self.group_id} was closed before it was trained")
+            if not trained:
+                msg = f"LargePersonGroup: {self.group_id} was not trained within {timeout} seconds"
+                logger.error(msg)
+                raise TimeoutError(msg)
+
+    def identify(self, face_ids: list, max_candidates: int = 5):
+        return match_against_person_group(
+            self.client, face_ids, large_person_group_id=self.group_id, max_candidates=max_candidates
+        )
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._trainer is not None:
+            self._trainer.join()
+            throttled_call("face", self.client.large_person_group.delete, self.group_id)
+            logger.info(f"Deleted LargePersonGroup: {self.group_id}")
+
+    def _train_forever(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._version > max(self._trained_version, self._failed_version) or self._closed
+                )
+                if self._closed:
+                    return
+                version = self._version
+
+            try:
+                self._train()
+            except Exception as e:
+                # Only the waiters of this round fail. The trainer carries on and retries with the next passenger
+                msg = f"Training LargePersonGroup: {self.group_id} up to version {version} failed: {e}"
+                logger.error(msg)
+                with self._condition:
+                    self._failed_version = version
+                    self._training_error = msg
+                    self._condition.notify_all()
+                continue
+
+            with self._condition:
+                self._trained_version = version
+                self._condition.notify_all()
+            logger.info(f"Trained LargePersonGroup: {self.group_id} up to version {version}")
+
+    def _train(self):
+        deadline = time.monotonic() + self.training_timeout
+        throttled_call("face", self.client.large_person_group.train, self.group_id)
+        while True:
+            training_status = throttled_call("face", self.client.large_person_group.get_training_status, self.group_id)
+            if training_status.status is TrainingStatusType.succeeded:
+                return
+            if training_status.status is TrainingStatusType.failed:
+                raise RuntimeError(training_status.message)
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Training did not finish within {self.training_timeout} seconds")
+            with self._condition:
+                # Closing the index stops the polling rather than waiting for training to finish
+                if self._condition.wait_for(lambda: self._closed, self.poll_interval):
+                    raise RuntimeError("LargePersonGroup was closed during training")
+
+
+class IdentifyBatcher:
+    """
+    Collects face ids from concurrently validated passengers and identifies them together.
+
+    A batch is sent once it holds `max_batch_size` face ids (the most `identify` accepts)
+    or `window` seconds after its first face id arrived, whichever comes first. The
+    candidates of each face are then handed back to the passenger that asked for them.
+
+    :param identify: Blocking call that takes a list of face ids and returns identify results,
+        e.g. `FlightIdentityIndex.identify`
+    """
+    def __init__(self, identify, window: float = 0.5, max_batch_size: int = 10):
+        self._identify = identify
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending = []
+        self._timer = None
+
+    async def identify(self, face_id: str) -> list:
+        """:return: Candidates for `face_id`"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((face_id, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
 
-        faces = client.face.detect_with_stream(image)
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            asyncio.ensure_future(self._send(batch))
 
-        for face in faces:
-            logging.info(f"Face ID: {face.face_id} found in image: {image_path}")
-            face_ids[image.name] = face.face_id
+    async def _send(self, batch):
+        face_ids = list(dict.fromkeys(face_id for face_id, _ in batch))
+        try:
+            results = await run_blocking(self._identify, face_ids)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
 
-    return face_ids
+        logger.info(f"Identified {len(face_ids)} faces in one call")
+        candidates = {str(result.face_id): result.candidates for result in results}
+        for face_id, future in batch:
+            if not future.done():
+                future.set_result(candidates.get(str(face_id), []))
+
+
+def _detect(client: FaceClient, image, image_key: str, return_face_attributes: list, cache: DiskCache, name: str):
+    """Faces in `image`, a local path, URL or the bytes of an image, cached by `image_key` when it is not `None`"""
+    cache_key = None
+    if cache is not None and image_key is not None:
+        cache_key = content_hash(image_key, ",".join(sorted(return_face_attributes or [])))
+        cached = cache.get(cache_key)
+        if cached and time.time() - cached["detected_at"] < FACE_ID_LIFETIME - FACE_ID_EXPIRY_MARGIN:
+            logger.info(f"Using cached faces for image: {name}")
+            return cached["faces"]
+
+    if isinstance(image, str) and any([image.startswith("http"), image.startswith("www.")]):
+        def detect_stream():
+            return client.face.detect_with_url(image, return_face_attributes=return_face_attributes)
+    else:
+        # Faces are detected on a downscaled copy, then mapped back onto the original image
+        preprocessed = preprocess_image(image, "face")
+
+        def detect_stream():
+            if preprocessed is None:
+                # Not an image that PIL can decode. It is sent as it is, like `open_image` does
+                with io.BytesIO(image) if isinstance(image, bytes) else open(image, "rb") as f:
+                    return client.face.detect_with_stream(f, return_face_attributes=return_face_attributes)
+
+            faces = client.face.detect_with_stream(
+                io.BytesIO(preprocessed.data), return_face_attributes=return_face_attributes
+            )
+            for face in faces:
+                rescale_face_rectangle(face.face_rectangle, preprocessed.scale)
+            return faces
+
+    detected_at = time.time()
+    faces = throttled_call("face", detect_stream)
+
+    for face in faces:
+        logger.info(f"Face ID: {face.face_id} found in image: {name}")
+    if cache_key is not None:
+        cache.set(cache_key, {"detected_at": detected_at, "faces": faces})
+    return faces
+
+
+def detect_faces_batch(
+        client: FaceClient,
+        image_list: list,
+        max_workers: int = 8,
+        return_face_attributes: list = None,
+        cache: DiskCache = FACE_ID_CACHE,
+        content_keys: dict = None
+) -> dict:
+    """
+    Detect faces in many images at the same time. At most `max_workers` images are open at once.
+    Images can be local paths or URLs, which the Face API fetches itself.
+
+    Detections are cached by image content with the time they were made. Images are only
+    detected again once their cached face ids are within `FACE_ID_EXPIRY_MARGIN` of expiring.
+
+    :param return_face_attributes: Face attributes to return, e.g. `["headPose", "blur"]`
+    :param cache: Cache of detections. `None` always calls the API
+    :param content_keys: Maps image URLs to keys identifying their content, e.g. the MD5 of a blob.
+        URLs without a key are not cached
+    :return: Maps each image to all the faces detected in it, as `DetectedFace` objects
+        with their `face_id`, `face_rectangle` and `face_attributes`
+    """
+    content_keys = content_keys or {}
+
+    def detect(image_path):
+        is_url = any([image_path.startswith("http"), image_path.startswith("www.")])
+        image_key = content_keys.get(image_path) or (None if is_url else file_hash(image_path))
+        return _detect(client, image_path, image_key, return_face_attributes, cache, image_path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return dict(zip(image_list, pool.map(detect, image_list)))
+
+
+def detect_faces_in_images(
+        client: FaceClient,
+        images: Iterable,
+        max_workers: int = 8,
+        return_face_attributes: list = None,
+        cache: DiskCache = FACE_ID_CACHE
+) -> dict:
+    """
+    Detect faces in images held in memory, e.g. thumbnails streamed by `iter_face_thumbnails`.
+    `images` is consumed as detections finish, so at most `max_workers` images are held at once.
+
+    :param images: `(name, image_bytes)` pairs
+    :return: Maps each name to the faces detected in its image, like `detect_faces_batch`
+    """
+    def detect(image):
+        name, data = image
+        return _detect(client, data, content_hash(data), return_face_attributes, cache, name)
+
+    return {name: faces for (name, _), faces in map_bounded(detect, images, max_workers)}
+
+
+def detect_faces(
+        client: FaceClient,
+        image_list: list,
+        max_workers: int = 8,
+        cache: DiskCache = FACE_ID_CACHE,
+        content_keys: dict = None
+):
+    """
+    :return: Maps each image with a face to the id of its largest face
+    """
+    detected_faces = detect_faces_batch(
+        client, image_list, max_workers=max_workers, cache=cache, content_keys=content_keys
+    )
+    return {image: faces[0].face_id for image, faces in detected_faces.items() if faces}
+
+
+async def detect_faces_batch_async(client: FaceClient, image_list: list, **kwargs) -> dict:
+    """`detect_faces_batch` on the event loop's executor"""
+    return await run_blocking(detect_faces_batch, client, image_list, **kwargs)
+
+
+async def detect_faces_async(client: FaceClient, image_list: list, **kwargs) -> dict:
+    """`detect_faces` on the event loop's executor"""
+    return await run_blocking(detect_faces, client, image_list, **kwargs)
 
 
 def verify_face(client: FaceClient, face_1: str, face_2: str):
-    verification = client.face.verify_face_to_face(face_1, face_2)
+    verification = throttled_call("face", client.face.verify_face_to_face, face_1, face_2)
     return verification.is_identical, verification.confidence
 
 
+async def verify_face_async(client: FaceClient, face_1: str, face_2: str):
+    """`verify_face` on the event loop's executor"""
+    return await run_blocking(verify_face, client, face_1, face_2)
+
+
 def get_bounding_box(face):
+    # `FaceRectangle` only has the top left corner and the size of the face
     bbox = face.face_rectangle
     top_left = (bbox.left, bbox.top)
-    bottom_right = (bbox.right, bbox.bottom)
+    bottom_right = (bbox.left + bbox.width, bbox.top + bbox.height)
     return top_left, bottom_right
 
 
 def draw_bbox(image_path, detected_faces, output_dir="outputs/faces/captures", outline="red", width=5):
-    p = Path(image_path)
-    img = Image.open(image_path)
-    draw = ImageDraw.Draw(img)
+    """
+    Save a copy of a local image with the faces detected in it outlined
 
-    for face in detected_faces:
-        draw.rectangle(get_bounding_box(face), outline=outline, width=width)
+    :param detected_faces: `DetectedFace` objects, e.g. the faces `detect_faces_batch` found in `image_path`
+    """
+    p = Path(image_path)
+    os.makedirs(output_dir, exist_ok=True)
+    with Image.open(image_path) as img:
+        draw = ImageDraw.Draw(img)
+        for face in detected_faces:
+            draw.rectangle(get_bounding_box(face), outline=outline, width=width)
 
-    filename = p.stem + "_bbox" + p.suffix
-    img.save(os.path.join(output_dir, filename))
+        filename = p.stem + "_bbox" + p.suffix
+        img.save(os.path.join(output_dir, filename))
     logger.info(f"Saved image with bounding box to: {output_dir}")
 
 
-def match_against_person_group(client: FaceClient, face_ids: list, person_group_id: str):
-    results = client.face.identify(face_ids, person_group_id)
+def match_against_person_group(
+        client: FaceClient,
+        face_ids: list,
+        person_group_id: str = None,
+        large_person_group_id: str = None,
+        max_candidates: int = 1
+):
+    results = throttled_call(
+        "face",
+        client.face.identify,
+        face_ids,
+        person_group_id=person_group_id,
+        large_person_group_id=large_person_group_id,
+        max_num_of_candidates_returned=max_candidates
+    )
     
     for result in results:
         for candidate in result.candidates:
-            logger.info(f"Candidate matched Person Group: {person_group_id} with confidence {candidate.confidence}")
+            logger.info(
+                f"Candidate matched Person Group: {person_group_id or large_person_group_id} "
+                f"with confidence {candidate.confidence}"
+            )
     return results
+
+
+async def match_against_person_group_async(client: FaceClient, face_ids: list, **kwargs):
+    """`match_against_person_group` on the event loop's executor"""
+    return await run_blocking(match_against_person_group, client, face_ids, **kwargs)
@@ -0,0 +1,192 @@
+"""
+Local stand-in for Video Indexer, to try out uploads, callbacks and index waits without an account.
+
+`FakeVideoIndexer` serves the Videos endpoints used by `ofurufu.video_analyzer` on localhost and
+calls the `callbackUrl` of each upload once the video is "indexed". Pass it wherever a
+`VideoIndexer` is expected:
+
+    python -m ofurufu.fake_indexer
+"""
+import argparse
+import io
+import itertools
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+import requests
+from PIL import Image
+
+from ofurufu.scheduler import run
+from ofurufu.video_analyzer import INDEXING_DONE_STATE
+from ofurufu.video_analyzer import IndexCallbackReceiver
+from ofurufu.video_analyzer import get_sentiment_and_emotion
+from ofurufu.video_analyzer import upload_video
+from ofurufu.video_analyzer import wait_for_index
+
+logging.basicConfig(
+    filename=f"logs/ofurufu_{time.time()}.log",
+    format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+PROCESSING_STATE = "Processing"
+
+
+def get_parser():
+    parser = argparse.ArgumentParser("Index a video on a local fake Video Indexer and wait on its callback")
+    parser.add_argument("--index-seconds", type=float, default=2, help="Seconds the fake takes to index a video")
+    parser.add_argument(
+        "--early-callback", action="store_true", help="Report videos as processed before they are indexed"
+    )
+    parser.add_argument("--thumbnails", type=int, default=3)
+    return parser.parse_args()
+
+
+def _thumbnail(index: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (40 * index % 256, 80, 160)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class FakeVideoIndexer:
+    """
+    HTTP server that answers like the Video Indexer Videos API and calls back on indexing.
+
+    :param index_seconds: Seconds after an upload at which its video is processed and the callback is sent
+    :param early_callback: Send a `Processed` callback as soon as the video is uploaded, while its index
+        is still processing, as a misbehaving or spoofed callback would
+    :param thumbnails: Face thumbnails in the index of each video
+    """
+    def __init__(self, index_seconds: float = 2, early_callback: bool = False, thumbnails: int = 3):
+        self.index_seconds = index_seconds
+        self.early_callback = early_callback
+        self.thumbnails = thumbnails
+        self.vi_location = "local"
+        self.vi_account_id = "fake"
+        self.access_token = "fake-token"
+        self.requests = []
+
+        self._ids = itertools.count(1)
+        self._processed = set()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.videos_url = f"http://127.0.0.1:{self._server.server_address[1]}/Videos"
+
+    def check_access_token(self):
+        pass
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def upload(self, callback_url: str = None) -> str:
+        video_id = f"fake-{next(self._ids)}"
+        if callback_url and self.early_callback:
+            self._call_back(callback_url, video_id, INDEXING_DONE_STATE)
+        threading.Timer(self.index_seconds, self._process, (video_id, callback_url)).start()
+        return video_id
+
+    def _process(self, video_id: str, callback_url: str):
+        with self._lock:
+            self._processed.add(video_id)
+        if callback_url:
+            self._call_back(callback_url, video_id, INDEXING_DONE_STATE)
+
+    @staticmethod
+    def _call_back(callback_url: str, video_id: str, state: str):
+        separator = "&" if urlparse(callback_url).query else "?"
+        requests.post(f"{callback_url}{separator}{urlencode({'id': video_id, 'state': state})}")
+
+    def index(self, video_id: str) -> dict:
+        with self._lock:
+            processed = video_id in self._processed
+        if not processed:
+            return {"id": video_id, "state": PROCESSING_STATE, "videos": [{"state": PROCESSING_STATE, "insights": {}}]}
+
+        thumbnails = [
+            {"id": f"{video_id}-{i}", "fileName": f"{video_id}_FaceThumbnail_{i}.jpg",
+             "instances": [{"adjustedStart": f"0:00:0{i}"}]}
+            for i in range(self.thumbnails)
+        ]
+        return {
+            "id": video_id,
+            "state": INDEXING_DONE_STATE,
+            "summarizedInsights": {
+                "sentiments": [{"sentimentKey": "Positive", "seenDurationRatio": 0.8}],
+                "emotions": [{"type": "Joy", "seenDurationRatio": 0.5}]
+            },
+            "videos": [{
+                "state": INDEXING_DONE_STATE,
+                "insights": {"faces": [{"id": 1, "name": "Unknown #1", "confidence": 0.99, "seenDuration": 5,
+                                        "thumbnails": thumbnails}]}
+            }]
+        }
+
+    def _make_handler(self):
+        fake = self
+
+        class FakeIndexerHandler(BaseHTTPRequestHandler):
+            def _send(self, status: int, body: bytes = b"", content_type: str = "application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                fake.requests.append(("POST", url.path))
+                if url.path != "/Videos":
+                    return self._send(404)
+                callback_url = parse_qs(url.query).get("callbackUrl", [None])[0]
+                self._send(200, json.dumps({"id": fake.upload(callback_url)}).encode())
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                fake.requests.append(("GET", url.path))
+                parts = url.path.strip("/").split("/")
+                if len(parts) == 3 and parts[2] == "Index":
+                    return self._send(200, json.dumps(fake.index(parts[1])).encode())
+                if len(parts) == 4 and parts[2] == "Thumbnails":
+                    return self._send(200, _thumbnail(int(parts[3].rsplit("-", 1)[1])), "image/jpeg")
+                self._send(404)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return FakeIndexerHandler
+
+
+if __name__ == "__main__":
+    args = get_parser()
+    with FakeVideoIndexer(args.index_seconds, args.early_callback, args.thumbnails) as indexer, \
+            IndexCallbackReceiver() as receiver:
+        callback_url = receiver.new_callback_url()
+        video_id = upload_video(indexer, "kiosk", video_url="https://example.com/kiosk.mp4", callback_url=callback_url)
+        receiver.bind(callback_url, video_id)
+
+        started = time.monotonic()
+        video_info = run(wait_for_index(indexer, video_id, timeout=60, initial_interval=1, receiver=receiver))
+        index_requests = sum(1 for method, path in indexer.requests if path.endswith("/Index"))
+        print(f"{video_info} after {time.monotonic() - started:.1f} seconds and {index_requests} index requests")
+        print(get_sentiment_and_emotion(video_info))
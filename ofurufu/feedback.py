@@ -41,4 +41,11 @@ PII_MISMATCH_MESSAGE = \
     Dear Sir/Madam,
     Some of the information on your {document} does not match the flight manifest data, so you cannot board the plane.
     Please see a customer service representative.
-    """
\ No newline at end of file
+    """
+
+PASSENGER_NOT_IN_MANIFEST_MESSAGE = \
+    """
+    Dear Sir/Madam,
+    We could not find you in the flight manifest, so you cannot board the plane.
+    Please see a customer service representative.
+    """
@@ -8,12 +8,21 @@ import yaml
 from azure.core.exceptions import ResourceNotFoundError
 from azure.ai.formrecognizer import FormRecognizerClient
 from azure.ai.formrecognizer import FormTrainingClient
+from azure.ai.formrecognizer.aio import FormRecognizerClient as AsyncFormRecognizerClient
 from azure.core.credentials import AzureKeyCredential
 
+from ofurufu.cache import DiskCache
+from ofurufu.cache import content_hash
+from ofurufu.cache import file_hash
+from ofurufu.preprocessing import open_image
+from ofurufu.throttling import throttled_call
+from ofurufu.throttling import throttled_call_async
 from ofurufu.variables import Variables
 
 v = Variables()
 
+ID_DOCUMENT_MODEL_ID = "prebuilt-idDocument"
+
 logging.basicConfig(
     filename=f"logs/ofurufu_{time.time()}.log",
     format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
@@ -42,12 +51,19 @@ def get_parser():
 
 
 def authenticate_form_client(
-        endpoint: str, key: str, training: bool = False
+        endpoint: str, key: str, training: bool = False, **kwargs
 ) -> Union[FormRecognizerClient, FormTrainingClient]:
     if training:
-        client = FormTrainingClient(endpoint, AzureKeyCredential(key))
+        client = FormTrainingClient(endpoint, AzureKeyCredential(key), **kwargs)
     else:
-        client = FormRecognizerClient(endpoint, AzureKeyCredential(key))
+        client = FormRecognizerClient(endpoint, AzureKeyCredential(key), **kwargs)
+    logger.info("Authenticated successfully")
+    return client
+
+
+def authenticate_form_client_async(endpoint: str, key: str, **kwargs) -> AsyncFormRecognizerClient:
+    """Form Recognizer client for use with `asyncio`. Close it with `await client.close()`"""
+    client = AsyncFormRecognizerClient(endpoint, AzureKeyCredential(key), **kwargs)
     logger.info("Authenticated successfully")
     return client
 
@@ -84,18 +100,45 @@ def train_boarding_pass_model(
     return None
 
 
-def analyze_id_document(client: FormRecognizerClient, document: str, **kwargs) -> list:
-    if any([document.startswith("http"), document.startswith("www.")]):
-        poller = client.begin_recognize_identity_documents_from_url(document)
-    elif os.path.exists(document):
-        poller = client.begin_recognize_identity_documents(open(document, "rb"))
-    else:
-        msg = "Document is not a valid local file path or url"
-        logger.error(msg)
-        raise ValueError(msg)
+def _document_key(document: str, content_key: str = None) -> Union[str, None]:
+    if content_key is not None:
+        return content_key
+    if os.path.exists(document):
+        return file_hash(document)
+    return None
+
+
+def get_cached_results(
+        cache: DiskCache, document: str, model_id: str, content_key: str = None
+) -> Union[list, None]:
+    """
+    Results previously extracted from a document with the same content by the same model.
+    `source` is set to `document` in the returned results.
+
+    :param content_key: Identifies the content of `document` when it is a URL, e.g. the MD5 of a blob.
+        Local documents are identified by their hash and URLs without a `content_key` are not cached
+    """
+    document_key = _document_key(document, content_key)
+    if cache is None or document_key is None:
+        return None
+
+    results = cache.get(content_hash(document_key, model_id))
+    if results is None:
+        return None
+
+    logger.info(f"Using cached results of model: {model_id} for document: {document}")
+    return [{**document_info, "source": (document, None)} for document_info in results]
+
+
+def cache_results(
+        cache: DiskCache, document: str, model_id: str, results: list, content_key: str = None
+) -> None:
+    document_key = _document_key(document, content_key)
+    if cache is not None and document_key is not None:
+        cache.set(content_hash(document_key, model_id), results)
 
-    page = poller.result()
 
+def extract_id_document_info(page, document: str) -> list:
     results = []
     for idx, id in enumerate(page):
         logger.info(f"--------Recognizing ID document #{idx + 1}--------")
@@ -120,19 +163,8 @@ def analyze_id_document(client: FormRecognizerClient, document: str, **kwargs) -
     return results
 
 
-def analyze_boarding_pass(client: FormRecognizerClient, model_id: str, document: str) -> list:
-    if any([document.startswith("http"), document.startswith("www.")]):
-        poller = client.begin_recognize_custom_forms_from_url(model_id=model_id, form_url=document)
-    elif os.path.exists(document):
-        poller = client.begin_recognize_custom_forms(model_id=model_id, form=open(document, "rb"))
-    else:
-        msg = "Document is not a valid local file path or url"
-        logger.error(msg)
-        raise ValueError(msg)
-
-    page = poller.result()
+def extract_boarding_pass_info(page, document: str) -> list:
     results = []
-
     for idx, doc in enumerate(page):
         logger.info(f"--------Recognizing Boarding Pass document #{idx + 1}--------")
         first_name = doc.fields.get("firstName", None)
@@ -162,6 +194,118 @@ def analyze_boarding_pass(client: FormRecognizerClient, model_id: str, document:
     return results
 
 
+def analyze_id_document(
+        client: FormRecognizerClient, document: str, cache: DiskCache = None, content_key: str = None, **kwargs
+) -> list:
+    cached_results = get_cached_results(cache, document, ID_DOCUMENT_MODEL_ID, content_key)
+    if cached_results is not None:
+        return cached_results
+
+    if any([document.startswith("http"), document.startswith("www.")]):
+        def recognize():
+            return client.begin_recognize_identity_documents_from_url(document).result()
+    elif os.path.exists(document):
+        def recognize():
+            with open_image(document, "form_recognizer") as f:
+                return client.begin_recognize_identity_documents(f).result()
+    else:
+        msg = "Document is not a valid local file path or url"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    page = throttled_call("form_recognizer", recognize)
+
+    results = extract_id_document_info(page, document)
+    cache_results(cache, document, ID_DOCUMENT_MODEL_ID, results, content_key)
+    return results
+
+
+def analyze_boarding_pass(
+        client: FormRecognizerClient, model_id: str, document: str, cache: DiskCache = None, content_key: str = None
+) -> list:
+    cached_results = get_cached_results(cache, document, model_id, content_key)
+    if cached_results is not None:
+        return cached_results
+
+    if any([document.startswith("http"), document.startswith("www.")]):
+        def recognize():
+            return client.begin_recognize_custom_forms_from_url(model_id=model_id, form_url=document).result()
+    elif os.path.exists(document):
+        def recognize():
+            with open_image(document, "form_recognizer") as f:
+                return client.begin_recognize_custom_forms(model_id=model_id, form=f).result()
+    else:
+        msg = "Document is not a valid local file path or url"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    page = throttled_call("form_recognizer", recognize)
+
+    results = extract_boarding_pass_info(page, document)
+    cache_results(cache, document, model_id, results, content_key)
+    return results
+
+
+async def analyze_id_document_async(
+        client: AsyncFormRecognizerClient, document: str, cache: DiskCache = None, content_key: str = None, **kwargs
+) -> list:
+    cached_results = get_cached_results(cache, document, ID_DOCUMENT_MODEL_ID, content_key)
+    if cached_results is not None:
+        return cached_results
+
+    if any([document.startswith("http"), document.startswith("www.")]):
+        async def recognize():
+            poller = await client.begin_recognize_identity_documents_from_url(document)
+            return await poller.result()
+    elif os.path.exists(document):
+        async def recognize():
+            with open_image(document, "form_recognizer") as f:
+                poller = await client.begin_recognize_identity_documents(f)
+            return await poller.result()
+    else:
+        msg = "Document is not a valid local file path or url"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    page = await throttled_call_async("form_recognizer", recognize)
+
+    results = extract_id_document_info(page, document)
+    cache_results(cache, document, ID_DOCUMENT_MODEL_ID, results, content_key)
+    return results
+
+
+async def analyze_boarding_pass_async(
+        client: AsyncFormRecognizerClient,
+        model_id: str,
+        document: str,
+        cache: DiskCache = None,
+        content_key: str = None
+) -> list:
+    cached_results = get_cached_results(cache, document, model_id, content_key)
+    if cached_results is not None:
+        return cached_results
+
+    if any([document.startswith("http"), document.startswith("www.")]):
+        async def recognize():
+            poller = await client.begin_recognize_custom_forms_from_url(model_id=model_id, form_url=document)
+            return await poller.result()
+    elif os.path.exists(document):
+        async def recognize():
+            with open_image(document, "form_recognizer") as f:
+                poller = await client.begin_recognize_custom_forms(model_id=model_id, form=f)
+            return await poller.result()
+    else:
+        msg = "Document is not a valid local file path or url"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    page = await throttled_call_async("form_recognizer", recognize)
+
+    results = extract_boarding_pass_info(page, document)
+    cache_results(cache, document, model_id, results, content_key)
+    return results
+
+
 def delete_trained_model(client: FormTrainingClient, model_id: str) -> None:
     client.delete_model(model_id=model_id)
 
@@ -0,0 +1,185 @@
+"""
+Local fast path for identity checks.
+
+Rather than waiting minutes for Video Indexer to index a passenger's video, frames are sampled
+from the video on the CPU, a Haar cascade checks each one for a face, and crops of the best few
+faces are sent on to Face detection and identification. Video Indexer is then only needed for
+the sentiments and emotions of the video, which do not decide boarding.
+"""
+import logging
+import os
+import time
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+from ofurufu.preprocessing import JPEG_QUALITY
+from ofurufu.video_analyzer import MAX_THUMBNAILS_PER_FACE
+from ofurufu.video_analyzer import ThumbnailCandidate
+from ofurufu.video_analyzer import dhash
+from ofurufu.video_analyzer import select_thumbnails
+
+logging.basicConfig(
+    filename=f"logs/ofurufu_{time.time()}.log",
+    format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+# Frames checked for a face per second of video
+FRAME_SAMPLE_RATE = 2.0
+# Frames are shrunk to this width before the face presence check, which is plenty for a kiosk close-up
+DETECTION_WIDTH = 320
+# Smallest face, in pixels of the original frame, that Face detects
+MIN_FACE_SIZE = 36
+# Crops extend this fraction of the face's size past each side of the face, so Face sees the whole head
+CROP_MARGIN = 0.5
+HISTOGRAM_BINS = 64
+
+
+class FrameSampler:
+    """
+    Picks the best crops of the passenger's face from frames of a video decoded on the CPU.
+
+    Frames are taken at `sample_rate` per second, or, with `scene_threshold`, only when the picture
+    has changed since the last frame taken. Frames without a face found by a Haar cascade are skipped.
+    The crops are then ranked like Video Indexer thumbnails by `select_thumbnails`, with the sharpness
+    of the face standing in for confidence. Requires `opencv-python`.
+
+    :param sample_rate: Frames checked per second of video
+    :param scene_threshold: Bhattacharyya distance, between 0 and 1, between the grayscale histograms
+        of a frame and the last frame taken above which the frame is a new scene. `None` takes every sampled frame
+    :param max_frames: Crops returned per video
+    :param cascade_path: Haar cascade of frontal faces. Defaults to the one shipped with OpenCV
+    """
+    def __init__(
+            self,
+            sample_rate: float = FRAME_SAMPLE_RATE,
+            scene_threshold: float = None,
+            max_frames: int = MAX_THUMBNAILS_PER_FACE,
+            cascade_path: str = None
+    ):
+        if cv2 is None:
+            msg = "Install `opencv-python` to sample faces from videos locally"
+            logger.error(msg)
+            raise ImportError(msg)
+        if sample_rate <= 0:
+            msg = "`sample_rate` must be positive"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.sample_rate = sample_rate
+        self.scene_threshold = scene_threshold
+        self.max_frames = max_frames
+        self.cascade_path = cascade_path or os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+        if cv2.CascadeClassifier(self.cascade_path).empty():
+            msg = f"Could not load Haar cascade: {self.cascade_path}"
+            logger.error(msg)
+            raise ValueError(msg)
+
+    def sample(self, video_path: str):
+        """
+        :param video_path: Local path or URL of the video
+        :return: Generator of `(seconds, frame)` of the sampled frames, as BGR arrays
+        """
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            msg = f"Could not open video: {video_path}"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        step = max(1, round(fps / self.sample_rate))
+        index = 0
+        try:
+            # Frames in between samples are only grabbed, not converted to arrays
+            while capture.grab():
+                if index % step == 0:
+                    retrieved, frame = capture.retrieve()
+                    if retrieved:
+                        yield index / fps, frame
+                index += 1
+        finally:
+            capture.release()
+
+    def _is_new_scene(self, gray, previous_histogram):
+        histogram = cv2.calcHist([gray], [0], None, [HISTOGRAM_BINS], [0, 256])
+        cv2.normalize(histogram, histogram)
+        if previous_histogram is None:
+            return True, histogram
+        distance = cv2.compareHist(previous_histogram, histogram, cv2.HISTCMP_BHATTACHARYYA)
+        if distance < self.scene_threshold:
+            return False, previous_histogram
+        return True, histogram
+
+    def extract(self, video_path: str, name: str = None) -> list:
+        """
+        :param name: Prefix of the names of the crops. Defaults to the file name of the video
+        :return: Up to `max_frames` `(name, jpeg_bytes)` crops of the face, in the order of the video
+        """
+        name = name or os.path.splitext(os.path.basename(video_path.split("?")[0]))[0]
+        cascade = cv2.CascadeClassifier(self.cascade_path)
+        candidates = []
+        histogram = None
+
+        for seconds, frame in self.sample(video_path):
+            scale = min(1.0, DETECTION_WIDTH / frame.shape[1])
+            small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else frame
+            gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+            if self.scene_threshold is not None:
+                is_new_scene, histogram = self._is_new_scene(gray, histogram)
+                if not is_new_scene:
+                    continue
+
+            min_size = max(1, round(MIN_FACE_SIZE * scale))
+            faces = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size))
+            if len(faces) == 0:
+                continue
+            x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+            sharpness = cv2.Laplacian(gray[y:y + h, x:x + w], cv2.CV_64F).var()
+
+            x, y, w, h = (round(value / scale) for value in (x, y, w, h))
+            margin_x, margin_y = round(w * CROP_MARGIN), round(h * CROP_MARGIN)
+            crop = frame[
+                max(0, y - margin_y):min(frame.shape[0], y + h + margin_y),
+                max(0, x - margin_x):min(frame.shape[1], x + w + margin_x)
+            ]
+            encoded, jpeg = cv2.imencode(".jpg", crop, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+            if not encoded:
+                continue
+
+            data = jpeg.tobytes()
+            candidates.append(ThumbnailCandidate(
+                face_id=0,
+                thumbnail_id=f"{seconds:.2f}",
+                file_name=f"{name}_{seconds:.2f}s.jpg",
+                time=seconds,
+                confidence=sharpness,
+                data=data,
+                size=w * h,
+                dhash=dhash(data)
+            ))
+
+        sharpest = max((candidate.confidence for candidate in candidates), default=0) or 1
+        for candidate in candidates:
+            candidate.confidence /= sharpest
+
+        selected = select_thumbnails(candidates, self.max_frames)
+        logger.info(f"Selected {len(selected)} of {len(candidates)} frames with a face in video: {video_path}")
+        return [(candidate.file_name, candidate.data) for candidate in selected]
+
+
+def load_frame_sampler(**kwargs):
+    """
+    :param kwargs: Passed on to `FrameSampler`
+    :return: The frame sampler, or `None` when it cannot be loaded and Video Indexer should be used
+    """
+    try:
+        return FrameSampler(**kwargs)
+    except Exception as e:
+        logger.warning(f"Could not load frame sampler, using Video Indexer instead: {e}")
+        return None
@@ -0,0 +1,110 @@
+"""
+Crash-safe journal of the stage results of each passenger.
+
+Every result is appended to a JSON lines file and synced to disk as soon as its stage finishes.
+A run resumed from the journal of a failed run reuses the recorded results, so only the stages
+that had not finished are run again.
+"""
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+from ofurufu.cache import content_hash
+
+logging.basicConfig(
+    filename=f"logs/ofurufu_{time.time()}.log",
+    format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+def passenger_key(passenger_documents: dict) -> str:
+    """Identifies a passenger of `passengers.yml` by their documents"""
+    return content_hash(json.dumps(passenger_documents, sort_keys=True, default=str))
+
+
+class Journal:
+    """
+    Append-only record of `(key, stage) -> result`, one JSON object per line.
+
+    Results are stored as JSON, with values JSON cannot represent, such as dates, stored as strings.
+    Tuples come back as lists.
+
+    :param path: JSON lines file of the journal
+    :param resume: Load the results recorded in `path` by an earlier run. Otherwise, `path` is started afresh
+    """
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self._results = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if resume and os.path.exists(path):
+            self._load()
+            logger.info(f"Resuming from {len(self._results)} results in journal: {path}")
+        self._file = open(path, "a" if resume else "w")
+
+    def _load(self):
+        with open(self.path, "rb+") as f:
+            content = f.read()
+            # A crash can cut off the last entry. It is dropped so that new entries start on a line of their own
+            end = content.rfind(b"\n") + 1
+            if end < len(content):
+                logger.warning(f"Dropping incomplete last entry of journal: {self.path}")
+                f.truncate(end)
+
+        for line in content[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping unreadable entry of journal: {self.path}")
+                continue
+            self._results[(entry["key"], entry["stage"])] = entry["result"]
+
+    def has(self, key: str, stage: str) -> bool:
+        return (key, stage) in self._results
+
+    def get(self, key: str, stage: str, default=None):
+        return self._results.get((key, stage), default)
+
+    def record(self, key: str, stage: str, result):
+        """Append the `result` of `stage` for `key` and sync it to disk"""
+        line = json.dumps({"key": key, "stage": stage, "result": result, "recorded_at": time.time()}, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._results[(key, stage)] = result
+
+    def wrap_stages(self, key: str, stages: dict) -> dict:
+        """
+        Stages of `run_stages` that return the result recorded for `key` when there is one,
+        and record their result when there is not
+        """
+        def journaled(stage, func):
+            async def run_stage(**inputs):
+                if self.has(key, stage):
+                    return self.get(key, stage)
+                result = func(**inputs)
+                if inspect.isawaitable(result):
+                    result = await result
+                self.record(key, stage, result)
+                return result
+
+            return run_stage
+
+        return {stage: (journaled(stage, func), dependencies) for stage, (func, dependencies) in stages.items()}
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
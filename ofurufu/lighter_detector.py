@@ -1,12 +1,26 @@
 import argparse
+import io
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from azure.cognitiveservices.vision.customvision.prediction import CustomVisionPredictionClient
 from azure.cognitiveservices.vision.customvision.training import CustomVisionTrainingClient
 from msrest.authentication import ApiKeyCredentials
+from PIL import Image
 
+try:
+    import numpy as np
+    import onnxruntime
+except ImportError:
+    np = None
+    onnxruntime = None
+
+from ofurufu.preprocessing import open_image
+from ofurufu.scheduler import run_blocking
+from ofurufu.throttling import throttled_call
 from ofurufu.variables import Variables
 
 v = Variables()
@@ -19,6 +33,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Tags of the detection model that are not allowed in carry-on luggage
+PROHIBITED_TAGS = ("lighter",)
+# Minimum probability, between 0 and 1, of a detection for it to count
+DETECTION_THRESHOLD = 0.5
+# Model exported from Custom Vision as ONNX, next to the `labels.txt` of the export
+ONNX_MODEL_PATH = "models/lighter_detector/model.onnx"
+BACKENDS = ("cloud", "onnx")
+# Metadata of ONNX exports declaring the channel order and pixel range of the model input, and the
+# values assumed when an export does not declare them
+PIXEL_FORMAT_KEY = "Image.BitmapPixelFormat"
+PIXEL_RANGE_KEY = "Image.NominalPixelRange"
+DEFAULT_PIXEL_FORMAT = "Bgr8"
+DEFAULT_PIXEL_RANGE = "NominalRange_0_255"
+# Channel orders of the model input, as indexes into RGB
+PIXEL_FORMATS = {"Bgr8": [2, 1, 0], "Rgb8": [0, 1, 2]}
+# `(scale, offset)` that map 0-255 pixel values onto the range of the model input
+PIXEL_RANGES = {
+    "NominalRange_0_255": (1.0, 0.0),
+    "Normalized_0_1": (1 / 255, 0.0),
+    "Normalized_1_1": (2 / 255, -1.0),
+}
+
 
 def get_parser():
     parser = argparse.ArgumentParser(
@@ -27,6 +63,17 @@ def get_parser():
     parser.add_argument("--analyse-image", action="store_true")
     parser.add_argument("--images", nargs="+")
     parser.add_argument("--model-iteration-name")
+    parser.add_argument(
+        "--threshold", type=float, default=DETECTION_THRESHOLD, help="Minimum probability of a detection"
+    )
+    parser.add_argument("--max-workers", type=int, default=8, help="Number of images scanned at the same time")
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="cloud",
+        help="Run detection with Custom Vision, or locally on an exported ONNX model. Falls back to Custom Vision"
+    )
+    parser.add_argument("--onnx-model", default=ONNX_MODEL_PATH)
     args = parser.parse_args()
 
     if args.analyse_image and not args.images:
@@ -41,7 +88,7 @@ def authenticate(key: str, training: bool = False):
     :param training: Get client for model training or predictions
     :return: TrainingClient or PredictionClient
     """
-    credentials = ApiKeyCredentials(in_headers={"Training-key": key})
+    credentials = ApiKeyCredentials(in_headers={"Training-key" if training else "Prediction-key": key})
 
     if training:
         logger.info("Getting client for training")
@@ -58,6 +105,26 @@ def train_model():
     raise NotImplementedError
 
 
+def _format_prediction(image: str, tag: str, probability: float, bounding_box: dict) -> dict:
+    result_format = "'\t'{0}: probability = {1:.2f}% bbox.left = {2:.2f}, bbox.top = {3:.2f}, " \
+                    "bbox.width = {4:.2f}, bbox.height = {5:.2f} "
+    prediction_probability = probability * 100
+    logger.info(result_format.format(
+        tag,
+        prediction_probability,
+        bounding_box["left"],
+        bounding_box["top"],
+        bounding_box["width"],
+        bounding_box["height"]
+    ))
+    return {
+        "source": image,
+        "tag": tag,
+        "prediction_probability": prediction_probability,
+        "bounding_box": bounding_box
+    }
+
+
 def make_prediction(
         client: CustomVisionPredictionClient,
         image: str,
@@ -65,17 +132,23 @@ def make_prediction(
         model_iteration_name: str
 ) -> list:
     if any([image.startswith("http"), image.startswith("www.")]):
-        results = client.detect_image_url(
+        results = throttled_call(
+            "custom_vision",
+            client.detect_image_url,
             project_id=project_id,
             published_name=model_iteration_name,
             url=image
         )
     elif os.path.exists(image):
-        results = client.detect_image(
-            project_id=project_id,
-            published_name=model_iteration_name,
-            image_data=open(image, "rb")
-        )
+        def detect():
+            with open_image(image, "custom_vision") as image_data:
+                return client.detect_image(
+                    project_id=project_id,
+                    published_name=model_iteration_name,
+                    image_data=image_data
+                )
+
+        results = throttled_call("custom_vision", detect)
     else:
         msg = "`image` is not a valid local file path or url"
         logger.error(msg)
@@ -84,32 +157,236 @@ def make_prediction(
     items = []
     logger.info(f"--------Detecting objects in image: {image}--------")
     for prediction in results.predictions:
-        result_format = "'\t'{0}: probability = {1:.2f}% bbox.left = {2:.2f}, bbox.top = {3:.2f}, " \
-                        "bbox.width = {4:.2f}, bbox.height = {5:.2f} "
-        prediction_probability = prediction.probability * 100
-        prediction_bbox = {
-            "left": prediction.bounding_box.left,
-            "top": prediction.bounding_box.top,
-            "width": prediction.bounding_box.width,
-            "height": prediction.bounding_box.height
-        }
-        logger.info(result_format.format(
+        items.append(_format_prediction(
+            image,
             prediction.tag_name,
-            prediction_probability,
-            prediction_bbox["left"],
-            prediction_bbox["top"],
-            prediction_bbox["width"],
-            prediction_bbox["height"]
+            prediction.probability,
+            {
+                "left": prediction.bounding_box.left,
+                "top": prediction.bounding_box.top,
+                "width": prediction.bounding_box.width,
+                "height": prediction.bounding_box.height
+            }
         ))
-        items.append({
-            "source": image,
-            "tag": prediction.tag_name,
-            "prediction_probability": prediction_probability,
-            "bounding_box": prediction_bbox
-        })
     return items
 
 
+async def make_prediction_async(
+        client: CustomVisionPredictionClient,
+        image: str,
+        project_id: str,
+        model_iteration_name: str
+) -> list:
+    """`make_prediction` on the event loop's executor"""
+    return await run_blocking(make_prediction, client, image, project_id, model_iteration_name)
+
+
+class OnnxLighterDetector:
+    """
+    Runs a Custom Vision object detection model exported as ONNX on the local CPU.
+
+    The model is loaded once and images are run through it in batches. Predictions have the
+    format of `make_prediction`, so the detector can stand in for Custom Vision.
+    Requires `onnxruntime` and `numpy`.
+
+    :param model_path: `model.onnx` of the export, with `detected_boxes`, `detected_scores`
+        and `detected_classes` outputs
+    :param labels_path: `labels.txt` of the export. Defaults to the one next to `model_path`
+    :param batch_size: Images per inference call, when the model accepts batches
+    :param min_probability: Detections below this probability, between 0 and 1, are dropped
+    """
+    def __init__(
+            self,
+            model_path: str = ONNX_MODEL_PATH,
+            labels_path: str = None,
+            batch_size: int = 16,
+            min_probability: float = 0.1
+    ):
+        if onnxruntime is None:
+            msg = "Install `onnxruntime` and `numpy` to run the lighter detector locally"
+            logger.error(msg)
+            raise ImportError(msg)
+
+        labels_path = labels_path or os.path.join(os.path.dirname(model_path), "labels.txt")
+        with open(labels_path, "r") as f:
+            self.labels = [line.strip() for line in f if line.strip()]
+
+        self.session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch_dim, _, self.input_height, self.input_width = model_input.shape
+        # Exports with a fixed batch dimension only take one image per call
+        self.batch_size = batch_size if not isinstance(batch_dim, int) else batch_dim
+        self.min_probability = min_probability
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.pixel_format = metadata.get(PIXEL_FORMAT_KEY, DEFAULT_PIXEL_FORMAT)
+        self.pixel_range = metadata.get(PIXEL_RANGE_KEY, DEFAULT_PIXEL_RANGE)
+        # An input the detector cannot prepare fails here, so that Custom Vision is used, rather
+        # than returning wrong scores
+        if self.pixel_format not in PIXEL_FORMATS:
+            msg = f"Unsupported pixel format of ONNX model: {model_path}: {self.pixel_format}"
+            logger.error(msg)
+            raise ValueError(msg)
+        if self.pixel_range not in PIXEL_RANGES:
+            msg = f"Unsupported pixel range of ONNX model: {model_path}: {self.pixel_range}"
+            logger.error(msg)
+            raise ValueError(msg)
+        logger.info(
+            f"Loaded ONNX model: {model_path} with labels: {self.labels}, "
+            f"pixel format: {self.pixel_format} and pixel range: {self.pixel_range}"
+        )
+
+    def _load(self, image: str):
+        if any([image.startswith("http"), image.startswith("www.")]):
+            response = requests.get(image)
+            response.raise_for_status()
+            image_data = io.BytesIO(response.content)
+        elif os.path.exists(image):
+            image_data = image
+        else:
+            msg = "`image` is not a valid local file path or url"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        with Image.open(image_data) as img:
+            img = img.convert("RGB").resize((self.input_width, self.input_height))
+            return np.asarray(img, dtype=np.float32)
+
+    def preprocess(self, images: list):
+        """
+        Stack images into an NCHW batch with the channel order and pixel range that the model's
+        metadata declares
+        """
+        batch = np.stack([self._load(image) for image in images])[..., PIXEL_FORMATS[self.pixel_format]]
+        scale, offset = PIXEL_RANGES[self.pixel_range]
+        if (scale, offset) != (1.0, 0.0):
+            batch = batch * np.float32(scale) + np.float32(offset)
+        return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+    def predict(self, images: list) -> dict:
+        """
+        :return: Maps each image to its detections, in the format of `make_prediction`
+        """
+        images = list(dict.fromkeys(images))
+        predictions = {}
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start:start + self.batch_size]
+            boxes, scores, classes = self.session.run(
+                ["detected_boxes", "detected_scores", "detected_classes"],
+                {self.input_name: self.preprocess(batch)}
+            )
+            for image, image_boxes, image_scores, image_classes in zip(batch, boxes, scores, classes):
+                logger.info(f"--------Detecting objects in image: {image}--------")
+                keep = image_scores >= self.min_probability
+                predictions[image] = [
+                    _format_prediction(
+                        image,
+                        self.labels[int(label)],
+                        float(score),
+                        {
+                            "left": float(x1),
+                            "top": float(y1),
+                            "width": float(x2 - x1),
+                            "height": float(y2 - y1)
+                        }
+                    )
+                    for (x1, y1, x2, y2), score, label in zip(
+                        image_boxes[keep], image_scores[keep], image_classes[keep]
+                    )
+                ]
+        return predictions
+
+
+def make_predictions(
+        client: CustomVisionPredictionClient,
+        images: list,
+        project_id: str,
+        model_iteration_name: str,
+        max_workers: int = 8
+) -> dict:
+    """
+    Detect objects in many images at the same time. Requests are spaced by the Custom Vision rate limit.
+
+    :return: Maps each image to its detections, in the format of `make_prediction`
+    """
+    images = list(dict.fromkeys(images))
+
+    def predict(image):
+        return make_prediction(client, image, project_id, model_iteration_name)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return dict(zip(images, pool.map(predict, images)))
+
+
+def get_luggage_verdict(items: list, threshold: float = DETECTION_THRESHOLD, tags: tuple = PROHIBITED_TAGS) -> dict:
+    """
+    :param items: Detections in the luggage images of one passenger
+    :return: `prohibited_item_found`, and the `detections` of prohibited items with
+        a probability of at least `threshold`, with their `source` image and `bounding_box`
+    """
+    tags = {tag.lower() for tag in tags}
+    detections = [
+        item for item in items
+        if item["tag"].lower() in tags and item["prediction_probability"] >= threshold * 100
+    ]
+    return {"prohibited_item_found": bool(detections), "detections": detections}
+
+
+def scan_luggage(
+        client: CustomVisionPredictionClient,
+        luggage: dict,
+        project_id: str,
+        model_iteration_name: str,
+        threshold: float = DETECTION_THRESHOLD,
+        tags: tuple = PROHIBITED_TAGS,
+        max_workers: int = 8,
+        local_detector: OnnxLighterDetector = None
+) -> dict:
+    """
+    Scan the luggage images of one or more passengers. Images of all the passengers are scanned
+    together, so a flight takes about as long as its slowest batch of `max_workers` images.
+
+    :param luggage: Maps each passenger to a list of their luggage images
+    :param local_detector: Scan locally instead of with Custom Vision. `client` is used if the local scan fails
+    :return: Maps each passenger to their verdict from `get_luggage_verdict`
+    """
+    images = [image for images in luggage.values() for image in images]
+    predictions = None
+    if local_detector is not None:
+        try:
+            predictions = local_detector.predict(images)
+        except Exception as e:
+            logger.warning(f"Local lighter detection failed, falling back to Custom Vision: {e}")
+
+    if predictions is None:
+        predictions = make_predictions(client, images, project_id, model_iteration_name, max_workers=max_workers)
+
+    verdicts = {}
+    for passenger, images in luggage.items():
+        items = [item for image in images for item in predictions[image]]
+        verdicts[passenger] = get_luggage_verdict(items, threshold, tags)
+        if verdicts[passenger]["prohibited_item_found"]:
+            logger.warning(f"Prohibited item found in luggage of: {passenger}")
+    return verdicts
+
+
+def load_local_detector(model_path: str = ONNX_MODEL_PATH):
+    """
+    :return: The ONNX detector, or `None` when it cannot be loaded and Custom Vision should be used
+    """
+    try:
+        return OnnxLighterDetector(model_path)
+    except Exception as e:
+        logger.warning(f"Could not load ONNX model: {model_path}, using Custom Vision instead: {e}")
+        return None
+
+
+async def scan_luggage_async(client: CustomVisionPredictionClient, luggage: dict, *args, **kwargs) -> dict:
+    """`scan_luggage` on the event loop's executor"""
+    return await run_blocking(scan_luggage, client, luggage, *args, **kwargs)
+
+
 if __name__ == "__main__":
     args = get_parser()
     client = authenticate(
@@ -117,10 +394,14 @@ if __name__ == "__main__":
         training=False if args.analyse_image else True
     )
     if args.analyse_image:
-        for image in args.images:
-            make_prediction(
-                client,
-                image,
-                v.CUSTOM_VISION_PROJECT_ID,
-                args.model_iteration_name or v.CUSTOM_VISION_DEFAULT_MODEL_ITERATION_NAME
-            )
+        verdicts = scan_luggage(
+            client,
+            {image: [image] for image in args.images},
+            v.CUSTOM_VISION_PROJECT_ID,
+            args.model_iteration_name or v.CUSTOM_VISION_DEFAULT_MODEL_ITERATION_NAME,
+            threshold=args.threshold,
+            max_workers=args.max_workers,
+            local_detector=load_local_detector(args.onnx_model) if args.backend == "onnx" else None
+        )
+        for image, verdict in verdicts.items():
+            print(f"{image}: {'prohibited item found' if verdict['prohibited_item_found'] else 'clear'}")
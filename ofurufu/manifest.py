@@ -0,0 +1,184 @@
+"""
+Flight manifest loaded once and indexed for passenger lookups.
+
+Rows are found in constant time by flight and name, or by seat. Names read from documents by
+OCR may be slightly off, so names without an exact match fall back to a trigram index and
+resolve to the most similar name on the flight.
+"""
+import csv
+import datetime
+import logging
+import re
+import time
+import unicodedata
+from collections import Counter
+from collections import defaultdict
+from typing import Union
+
+logging.basicConfig(
+    filename=f"logs/ofurufu_{time.time()}.log",
+    format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+FLIGHT_FIELD = "Flight No"
+FIRST_NAME_FIELD = "First Name"
+LAST_NAME_FIELD = "Last Name"
+SEAT_FIELD = "SeatNo"
+
+DATE_FORMATS = ("%d %B %Y", "%d %b %Y", "%B %d %Y", "%b %d %Y", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y")
+TIME_FORMATS = ("%H:%M", "%H:%M:%S", "%I:%M %p", "%I:%M%p", "%I %p")
+
+# Lowest similarity, between 0 and 1, of a fuzzy name match
+NAME_SIMILARITY_THRESHOLD = 0.6
+# Rows sharing the most trigrams with a name that are scored for a fuzzy match
+FUZZY_CANDIDATES = 10
+
+
+def clean_text(text: str):
+    return text.strip().lower().replace(" ", "_")
+
+
+def get_value(field):
+    """
+    Value of a field recognized by Form Recognizer, which is a `(value, confidence)` pair,
+    or a list once read back from a journal
+    """
+    return field[0] if isinstance(field, (tuple, list)) else field
+
+
+def normalize_name(*names: str) -> str:
+    """Lowercase name without accents, punctuation or repeated spaces"""
+    name = " ".join(str(name) for name in names if name)
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", name.lower()).split())
+
+
+def _parse(value, formats, parse_type):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value
+    text = " ".join(str(value).replace(",", " ").split())
+    for fmt in formats:
+        try:
+            return parse_type(datetime.datetime.strptime(text, fmt))
+        except ValueError:
+            continue
+    return clean_text(text)
+
+
+def normalize_date(value) -> Union[datetime.date, str]:
+    """Date in any of `DATE_FORMATS`, or the cleaned text if it cannot be parsed"""
+    return _parse(value, DATE_FORMATS, lambda parsed: parsed.date())
+
+
+def normalize_time(value) -> Union[datetime.time, str]:
+    """Time in any of `TIME_FORMATS`, or the cleaned text if it cannot be parsed"""
+    return _parse(value, TIME_FORMATS, lambda parsed: parsed.time())
+
+
+def trigrams(name: str) -> set:
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ManifestStore:
+    """
+    Rows of a flight manifest with hash indexes on `(flight, name)` and `(flight, seat)`,
+    and a trigram index on the names of each flight for fuzzy lookups.
+
+    Rows keep the manifest's header as keys, with surrounding whitespace stripped from values.
+
+    :param header: Columns of the manifest
+    :param rows: Manifest rows as dicts keyed by `header`
+    """
+    def __init__(self, header: list, rows: list):
+        self.header = header
+        self.rows = rows
+        self._by_name = defaultdict(list)
+        self._by_seat = {}
+        self._trigrams = defaultdict(set)
+        self._names = []
+
+        for idx, row in enumerate(rows):
+            flight = clean_text(row[FLIGHT_FIELD])
+            name = normalize_name(row[FIRST_NAME_FIELD], row[LAST_NAME_FIELD])
+            self._names.append(name)
+            self._by_name[(flight, name)].append(idx)
+            self._by_seat[(flight, clean_text(row[SEAT_FIELD]))] = idx
+            for trigram in trigrams(name):
+                self._trigrams[(flight, trigram)].add(idx)
+        self.flights = sorted({clean_text(row[FLIGHT_FIELD]) for row in rows})
+
+    @classmethod
+    def load(cls, path: str) -> "ManifestStore":
+        with open(path, "r") as f:
+            reader = csv.reader(f)
+            header = [column.strip() for column in next(reader)]
+            rows = [{column: value.strip() for column, value in zip(header, row)} for row in reader if row]
+        logger.info(f"Loaded {len(rows)} passengers from manifest: {path}")
+        return cls(header, rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def _flights(self, flight_no):
+        return [clean_text(flight_no)] if flight_no else self.flights
+
+    def find(
+            self,
+            first_name: str,
+            last_name: str,
+            flight_no: str = None,
+            min_similarity: float = NAME_SIMILARITY_THRESHOLD
+    ) -> Union[dict, None]:
+        """
+        Row of the passenger named `first_name last_name` on `flight_no`, or on any flight if not given.
+        Names without an exact match resolve to the most similar name with a similarity of at least
+        `min_similarity`. Returns `None` when no row matches.
+        """
+        name = normalize_name(first_name, last_name)
+        flights = set(self._flights(flight_no))
+        for swapped in (name, normalize_name(last_name, first_name)):
+            for flight in flights:
+                matches = self._by_name.get((flight, swapped))
+                if matches:
+                    if len(matches) > 1:
+                        logger.warning(f"{len(matches)} passengers named: {swapped} on flight: {flight}")
+                    return self.rows[matches[0]]
+
+        return self._find_similar(name, flights, min_similarity)
+
+    def _find_similar(self, name: str, flights: set, min_similarity: float) -> Union[dict, None]:
+        name_trigrams = trigrams(name)
+        shared = Counter()
+        for flight in flights:
+            for trigram in name_trigrams:
+                shared.update(self._trigrams.get((flight, trigram), ()))
+
+        best_idx, best_similarity = None, 0.0
+        for idx, count in shared.most_common(FUZZY_CANDIDATES):
+            # Dice coefficient of the two trigram sets
+            similarity = 2 * count / (len(name_trigrams) + len(trigrams(self._names[idx])))
+            if similarity > best_similarity:
+                best_idx, best_similarity = idx, similarity
+
+        if best_idx is None or best_similarity < min_similarity:
+            logger.warning(f"No passenger in the manifest matches the name: {name}")
+            return None
+
+        logger.info(
+            f"Matched name: {name} to passenger: {self._names[best_idx]} with similarity: {best_similarity:.2f}"
+        )
+        return self.rows[best_idx]
+
+    def find_by_seat(self, seat: str, flight_no: str = None) -> Union[dict, None]:
+        for flight in self._flights(flight_no):
+            idx = self._by_seat.get((flight, clean_text(seat)))
+            if idx is not None:
+                return self.rows[idx]
+        return None
@@ -0,0 +1,154 @@
+"""
+Shrinks images before they are sent to the Azure services.
+
+Phone photos, lighter images and PNG ID cards are much larger than the services need.
+Images are turned upright from their EXIF orientation, downscaled to the maximum size of
+the service they are sent to and re-encoded as JPEG, all in memory. Results are cached by
+the content of the original image.
+"""
+import io
+import logging
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Union
+
+from PIL import Image
+from PIL import ImageOps
+from PIL import UnidentifiedImageError
+
+from ofurufu.cache import CACHE_DIR
+from ofurufu.cache import DiskCache
+from ofurufu.cache import content_hash
+from ofurufu.cache import file_hash
+
+logging.basicConfig(
+    filename=f"logs/ofurufu_{time.time()}.log",
+    format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+# Longest side, in pixels, of the images sent to each service. Face detects faces down to
+# 36px and Form Recognizer needs legible text, so they keep more resolution than Custom Vision
+MAX_IMAGE_SIZES = {
+    "face": 1920,
+    "form_recognizer": 2048,
+    "custom_vision": 1024,
+}
+JPEG_QUALITY = 90
+EXIF_ORIENTATION = 0x0112
+
+PREPROCESSING_CACHE = DiskCache(
+    os.path.join(CACHE_DIR, "preprocessing"), ttl=7 * 24 * 60 * 60, max_size=512 * 1024 * 1024
+)
+
+
+@dataclass(frozen=True)
+class PreprocessedImage:
+    """
+    :param data: Encoded image to send
+    :param scale: Size of the sent image relative to the original. Coordinates returned by a
+        service are divided by `scale` to map them back onto the original image
+    """
+    data: bytes
+    scale: float = 1.0
+
+
+def _read(image: Union[str, bytes]) -> bytes:
+    if isinstance(image, bytes):
+        return image
+    with open(image, "rb") as f:
+        return f.read()
+
+
+def _shrink(original: bytes, max_size: int, quality: int) -> Union[PreprocessedImage, None]:
+    try:
+        img = Image.open(io.BytesIO(original))
+        img.load()
+    except (UnidentifiedImageError, OSError):
+        # Not an image PIL can read, e.g. a PDF boarding pass
+        return None
+
+    rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+    upright = ImageOps.exif_transpose(img) if rotated else img
+    scale = min(1.0, max_size / max(upright.size))
+    if img.format == "JPEG" and not rotated and scale == 1.0:
+        # Re-encoding would only lose quality
+        return PreprocessedImage(original)
+
+    if scale < 1.0:
+        upright = upright.resize(
+            (max(1, round(upright.width * scale)), max(1, round(upright.height * scale))), Image.LANCZOS
+        )
+
+    buffer = io.BytesIO()
+    upright.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+    if buffer.tell() >= len(original) and not rotated and scale == 1.0:
+        return PreprocessedImage(original)
+    return PreprocessedImage(buffer.getvalue(), scale)
+
+
+def preprocess_image(
+        image: Union[str, bytes],
+        service: str,
+        quality: int = JPEG_QUALITY,
+        cache: DiskCache = PREPROCESSING_CACHE
+) -> Union[PreprocessedImage, None]:
+    """
+    Upright, downscaled JPEG of `image` for `service`, one of `MAX_IMAGE_SIZES`.
+    Small, upright JPEGs are returned unchanged.
+
+    :param image: Local path or the bytes of an image
+    :param quality: JPEG quality of re-encoded images, from 1 to 95
+    :param cache: Cache of preprocessed images. `None` always preprocesses
+    :return: The preprocessed image, or `None` when `image` is not an image, e.g. a PDF
+    """
+    max_size = MAX_IMAGE_SIZES[service]
+    image_key = content_hash(image) if isinstance(image, bytes) else file_hash(image)
+    cache_key = content_hash(image_key, str(max_size), str(quality))
+
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    original = _read(image)
+    preprocessed = _shrink(original, max_size, quality)
+    if preprocessed is not None:
+        logger.info(
+            f"Preprocessed image for {service}: {len(original)} -> {len(preprocessed.data)} bytes, "
+            f"scale {preprocessed.scale:.2f}"
+        )
+        if cache is not None:
+            cache.set(cache_key, preprocessed)
+    return preprocessed
+
+
+@contextmanager
+def open_image(path: Union[str, bytes], service: str, **kwargs):
+    """
+    Stream of the preprocessed image at `path`, or in bytes, for `service`, or of the original
+    when it is not an image
+    """
+    preprocessed = preprocess_image(path, service, **kwargs)
+    if preprocessed is None and isinstance(path, bytes):
+        yield io.BytesIO(path)
+    elif preprocessed is None:
+        with open(path, "rb") as f:
+            yield f
+    else:
+        yield io.BytesIO(preprocessed.data)
+
+
+def rescale_face_rectangle(face_rectangle, scale: float):
+    """Map a `FaceRectangle` detected on an image preprocessed with `scale` onto the original image"""
+    if scale == 1.0:
+        return face_rectangle
+    face_rectangle.left = round(face_rectangle.left / scale)
+    face_rectangle.top = round(face_rectangle.top / scale)
+    face_rectangle.width = round(face_rectangle.width / scale)
+    face_rectangle.height = round(face_rectangle.height / scale)
+    return face_rectangle
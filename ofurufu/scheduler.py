@@ -0,0 +1,143 @@
+import asyncio
+import functools
+import inspect
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+
+async def run_blocking(func: Callable, *args, **kwargs):
+    """
+    Run a blocking call (Azure SDK, requests) on the loop's executor so that
+    the event loop keeps driving other passengers while it waits.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def gather_bounded(tasks: Iterable[Callable[[], Awaitable]], concurrency: int) -> List:
+    """
+    Await the coroutines produced by `tasks` with at most `concurrency` of them in flight.
+    Results are returned in the same order as `tasks`, regardless of completion order.
+
+    :param tasks: Zero-argument callables that each return an awaitable
+    :param concurrency: Maximum number of awaitables running at the same time
+    :return: List of results ordered as `tasks`
+    """
+    if concurrency < 1:
+        raise ValueError("`concurrency` must be at least 1")
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(task):
+        async with semaphore:
+            return await task()
+
+    return await asyncio.gather(*[bounded(task) for task in tasks])
+
+
+def map_bounded(func: Callable, items: Iterable, max_workers: int) -> Iterator[Tuple[Any, Any]]:
+    """
+    Call `func` on `items` on a pool of `max_workers` threads, yielding `(item, result)` as calls finish.
+    `items` are pulled only as calls finish, so at most `max_workers` items and results are held at once
+    and `items` may be a generator.
+    """
+    if max_workers < 1:
+        raise ValueError("`max_workers` must be at least 1")
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+
+        def submit():
+            for item in items:
+                pending[pool.submit(func, item)] = item
+                return
+
+        for _ in range(max_workers):
+            submit()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                submit()
+                yield item, future.result()
+
+
+def run(coroutine: Awaitable, max_workers: int = None):
+    """
+    Run `coroutine` to completion on a fresh event loop whose default executor
+    has `max_workers` threads for blocking calls made through `run_blocking`.
+    """
+    async def main():
+        if max_workers:
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_workers))
+        return await coroutine
+
+    return asyncio.run(main())
+
+
+async def run_stages(stages: Dict[str, Tuple[Callable, List[str]]]) -> Dict[str, Any]:
+    """
+    Run a dependency graph of stages. Every stage starts as soon as the stages it depends on
+    have finished, so independent stages run at the same time.
+
+    :param stages: Maps a stage name to `(func, dependencies)`. `func` is called with the results
+        of its dependencies as keyword arguments and may return a value or an awaitable.
+    :return: Results of all stages, keyed by stage name
+    """
+    for name, (_, dependencies) in stages.items():
+        missing = [d for d in dependencies if d not in stages]
+        if missing:
+            raise ValueError(f"Stage `{name}` depends on unknown stages: {missing}")
+    _check_acyclic(stages)
+
+    tasks = {}
+
+    async def run_stage(func, dependencies):
+        inputs = {dependency: await tasks[dependency] for dependency in dependencies}
+        result = func(**inputs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    for name, (func, dependencies) in stages.items():
+        tasks[name] = asyncio.ensure_future(run_stage(func, dependencies))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        # Let the cancelled stages finish unwinding rather than leaving them pending
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+
+    return {name: task.result() for name, task in tasks.items()}
+
+
+def _check_acyclic(stages):
+    visited, in_progress = set(), set()
+
+    def visit(name):
+        if name in in_progress:
+            raise ValueError(f"Stage `{name}` is part of a dependency cycle")
+        if name in visited:
+            return
+        in_progress.add(name)
+        for dependency in stages[name][1]:
+            visit(dependency)
+        in_progress.remove(name)
+        visited.add(name)
+
+    for name in stages:
+        visit(name)
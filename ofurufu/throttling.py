@@ -0,0 +1,243 @@
+"""
+Client-side rate limiting for Azure calls.
+
+Every call to a service goes through that service's `ServiceLimiter`, which
+* spaces requests with a token bucket sized to the subscription's requests per second,
+* caps the requests in flight with a limit tuned AIMD-style: it grows by one per
+  window of successful calls and halves, at most once per `decrease_window`, when the service throttles, and
+* retries throttled calls (429/503) after `Retry-After`, or a jittered exponential backoff.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Callable
+
+logging.basicConfig(
+    filename=f"logs/ofurufu_{time.time()}.log",
+    format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+THROTTLED_STATUS_CODES = (429, 503)
+
+# Requests per second and maximum concurrent requests of the S0 tiers
+SERVICE_LIMITS = {
+    "face": {"rate": 10, "max_concurrency": 10},
+    "form_recognizer": {"rate": 15, "max_concurrency": 15},
+    "custom_vision": {"rate": 10, "max_concurrency": 10},
+    "video_indexer": {"rate": 2, "burst": 10, "max_concurrency": 10},
+    "blob": {"rate": 500, "max_concurrency": 64},
+}
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `burst`"""
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """Take a token if one is available. Otherwise, return the seconds until one is"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        wait = self.try_acquire()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    async def acquire_async(self):
+        wait = self.try_acquire()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire()
+
+
+class ServiceLimiter:
+    """
+    Rate, concurrency and retry policy for the calls to one service.
+
+    :param rate: Requests per second
+    :param burst: Requests that can be sent at once after an idle period. Defaults to `rate`
+    :param max_concurrency: Upper bound of the adaptive concurrency limit
+    :param max_retries: Retries of a throttled call before its error is raised
+    :param base_delay: First backoff delay in seconds when the service sends no `Retry-After`
+    :param max_delay: Largest backoff delay in seconds
+    :param decrease_window: Seconds after halving the limit during which further throttled calls do not
+        halve it again. A burst of calls sent before the first one was throttled counts as one decrease
+    """
+    def __init__(
+            self,
+            name: str,
+            rate: float,
+            burst: float = None,
+            max_concurrency: int = 8,
+            max_retries: int = 5,
+            base_delay: float = 1,
+            max_delay: float = 60,
+            decrease_window: float = 1
+    ):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.decrease_window = decrease_window
+
+        self.limit = float(max_concurrency)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._last_decrease = None
+        # `(loop, future)` of the coroutines waiting for a slot, woken from whichever thread frees one
+        self._async_waiters = []
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        Call `func` within the limits of the service. `func` may be called again when it is
+        throttled, so it should not consume arguments such as open streams: open them inside `func`.
+        """
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            self.bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self._release()
+                if not is_throttled(e) or attempt == self.max_retries:
+                    raise
+                time.sleep(self._on_throttled(e, attempt))
+                continue
+
+            self._release(succeeded=True)
+            return result
+
+    async def call_async(self, func: Callable, *args, **kwargs):
+        """Like `call`, for a coroutine function `func`. Waits without blocking the event loop"""
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_async()
+            await self.bucket.acquire_async()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                self._release()
+                if not is_throttled(e) or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._on_throttled(e, attempt))
+                continue
+
+            self._release(succeeded=True)
+            return result
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _acquire(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+
+    async def _acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._in_flight < int(self.limit):
+                    self._in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def _release(self, succeeded: bool = False):
+        with self._condition:
+            self._in_flight -= 1
+            if succeeded:
+                # Additive increase: about one more slot per `limit` successful calls
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # The waiter's event loop has been closed
+                pass
+
+    def _on_throttled(self, error, attempt) -> float:
+        """Halve the concurrency limit, once per `decrease_window`, and return the seconds to wait before retrying"""
+        with self._condition:
+            now = time.monotonic()
+            if self._last_decrease is None or now - self._last_decrease >= self.decrease_window:
+                # Multiplicative decrease
+                self.limit = max(1.0, self.limit / 2)
+                self._last_decrease = now
+
+        delay = max(get_retry_after(error) or 0, self._backoff(attempt))
+        logger.warning(
+            f"{self.name} throttled the request. Retrying in {delay:.1f} seconds "
+            f"with concurrency limit {int(self.limit)}"
+        )
+        return delay
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _get_response(error):
+    return getattr(error, "response", None)
+
+
+def is_throttled(error: Exception) -> bool:
+    status_code = getattr(error, "status_code", None)
+    response = _get_response(error)
+    if status_code is None and response is not None:
+        status_code = getattr(response, "status_code", None)
+    return status_code in THROTTLED_STATUS_CODES
+
+
+def get_retry_after(error: Exception):
+    """Seconds to wait from the `Retry-After` header of a throttled response, if any"""
+    response = _get_response(error)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(service: str) -> ServiceLimiter:
+    with _limiters_lock:
+        if service not in _limiters:
+            _limiters[service] = ServiceLimiter(service, **SERVICE_LIMITS[service])
+        return _limiters[service]
+
+
+def throttled_call(service: str, func: Callable, *args, **kwargs):
+    """Call `func` through the limiter of `service`, one of `SERVICE_LIMITS`"""
+    return get_limiter(service).call(func, *args, **kwargs)
+
+
+async def throttled_call_async(service: str, func: Callable, *args, **kwargs):
+    """Await the coroutine function `func` through the limiter of `service`"""
+    return await get_limiter(service).call_async(func, *args, **kwargs)
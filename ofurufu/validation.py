@@ -1,98 +1,232 @@
+import argparse
+import asyncio
 import csv
+import functools
+import logging
 import os
 import time
+from urllib.parse import urlparse
 
-from msrest.authentication import CognitiveServicesCredentials
 import yaml
 
 import ofurufu.feedback as f
-from ofurufu.blob import authenticate_blob_client
-from ofurufu.blob import download_blob
-from ofurufu.face_recognition import authenticate_face_client
-from ofurufu.face_recognition import create_person_group
-from ofurufu.face_recognition import match_against_person_group
+from ofurufu.blob import get_blob_document
+from ofurufu.blob import get_blob_url
+from ofurufu.cache import CACHE_DIR
+from ofurufu.cache import DiskCache
+from ofurufu.clients import close_async_clients
+from ofurufu.clients import get_blob_service_client
+from ofurufu.clients import get_face_client
+from ofurufu.clients import get_form_client
+from ofurufu.clients import get_form_client_async
+from ofurufu.clients import get_indexer
+from ofurufu.clients import get_local_lighter_detector
+from ofurufu.clients import get_prediction_client
+from ofurufu.clients import get_session
+from ofurufu.face_recognition import TRAINING_TIMEOUT
+from ofurufu.face_recognition import FlightIdentityIndex
+from ofurufu.face_recognition import IdentifyBatcher
 from ofurufu.face_recognition import detect_faces
-from ofurufu.form_recognizer import authenticate_form_client
+from ofurufu.face_recognition import detect_faces_in_images
 from ofurufu.form_recognizer import analyze_boarding_pass
+from ofurufu.form_recognizer import analyze_boarding_pass_async
 from ofurufu.form_recognizer import analyze_id_document
+from ofurufu.form_recognizer import analyze_id_document_async
+from ofurufu.frames import FRAME_SAMPLE_RATE
+from ofurufu.frames import load_frame_sampler
+from ofurufu.journal import Journal
+from ofurufu.journal import passenger_key
+from ofurufu.lighter_detector import BACKENDS
+from ofurufu.lighter_detector import DETECTION_THRESHOLD
+from ofurufu.lighter_detector import ONNX_MODEL_PATH
+from ofurufu.lighter_detector import scan_luggage_async
+from ofurufu.manifest import ManifestStore
+from ofurufu.manifest import clean_text
+from ofurufu.manifest import get_value
+from ofurufu.manifest import normalize_date
+from ofurufu.manifest import normalize_time
+from ofurufu.scheduler import gather_bounded
+from ofurufu.scheduler import run
+from ofurufu.scheduler import run_blocking
+from ofurufu.scheduler import run_stages
 from ofurufu.variables import Variables
-from ofurufu.video_analyzer import authenticate_video_indexer
+from ofurufu.video_analyzer import INDEXING_PRESETS
+from ofurufu.video_analyzer import IndexCallbackReceiver
+from ofurufu.video_analyzer import VideoRegistry
 from ofurufu.video_analyzer import get_sentiment_and_emotion
-from ofurufu.video_analyzer import save_face_thumbnails
+from ofurufu.video_analyzer import select_face_thumbnails
 
 v = Variables()
 
-
-def get_clients():
-    form_client = authenticate_form_client(
-        v.FORM_RECOGNIZER_ENDPOINT, v.FORM_RECOGNIZER_KEY, training=False)
-
-    face_client = authenticate_face_client(
-        v.FACE_RECOGNIZER_ENDPOINT,
-        CognitiveServicesCredentials(v.FACE_RECOGNIZER_SUBSCRIPTION_KEY) 
+logging.basicConfig(
+    filename=f"logs/ofurufu_{time.time()}.log",
+    format="%(asctime)s - %(levelname)s - %(name)s - PID: %(process)d -  %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+DOCUMENT_TYPES = ("id_card", "boarding_pass", "video")
+
+FORM_RECOGNIZER_CACHE = DiskCache(
+    os.path.join(CACHE_DIR, "form_recognizer"), ttl=7 * 24 * 60 * 60, max_size=256 * 1024 * 1024
+)
+VIDEO_INDEX_CACHE = DiskCache(
+    os.path.join(CACHE_DIR, "video_indexer"), ttl=30 * 24 * 60 * 60, max_size=512 * 1024 * 1024
+)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser("CLI for validating passengers against the flight manifest")
+    parser.add_argument("--passengers", default="passengers.yml")
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Number of passengers validated at the same time"
     )
-
-    indexer = authenticate_video_indexer(
-        v.VIDEO_ANALYZER_SUBSCRIPTION_KEY,
-        v.VIDEO_ANALYZER_LOCATION,
-        v.VIDEO_ANALYZER_ACCOUNT_ID
+    parser.add_argument(
+        "--callback-url", help="Public URL forwarded to the local callback receiver. Disables polling"
     )
-
-    blob_service_client = authenticate_blob_client(
-        v.BLOB_ACCOUNT_NAME, v.BLOB_ACCOUNT_KEY
+    parser.add_argument("--callback-port", type=int, default=8765)
+    parser.add_argument("--indexing-preset", choices=INDEXING_PRESETS, default="Default")
+    parser.add_argument(
+        "--luggage-threshold",
+        type=float,
+        default=DETECTION_THRESHOLD,
+        help="Minimum probability of a lighter detection for luggage to be flagged"
     )
-    return form_client, face_client, indexer, blob_service_client
-
+    parser.add_argument(
+        "--luggage-backend",
+        choices=BACKENDS,
+        default="cloud",
+        help="Scan luggage with Custom Vision, or locally on an exported ONNX model. Falls back to Custom Vision"
+    )
+    parser.add_argument("--onnx-model", default=ONNX_MODEL_PATH)
+    parser.add_argument(
+        "--frame-sampling",
+        action="store_true",
+        help="Take faces from frames of the videos sampled locally rather than from Video Indexer thumbnails"
+    )
+    parser.add_argument("--frame-rate", type=float, default=FRAME_SAMPLE_RATE, help="Frames sampled per second")
+    parser.add_argument(
+        "--scene-threshold", type=float, help="Only sample frames that differ from the last by this much, from 0 to 1"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Reuse the passengers and stages recorded in the journal of an earlier run of the flight"
+    )
+    parser.add_argument(
+        "--stage-videos",
+        action="store_true",
+        help="Stage local videos in the blob `container` of the passengers file and index them by URL"
+    )
+    args = parser.parse_args()
 
-def clean_text(text: str):
-    return text.strip().lower().replace(" ", "_")
+    if args.concurrency < 1:
+        raise ValueError("`concurrency` must be at least 1")
+    return args
 
 
-def get_pii_from_id_card(id_card, form_client=None):
-    if form_client is None:
-        form_client = authenticate_form_client(
-            v.FORM_RECOGNIZER_ENDPOINT, v.FORM_RECOGNIZER_KEY, training=False
-        )
-    
-    results = analyze_id_document(form_client, id_card)
+def get_pii_from_id_card(id_card, form_client=None, cache=FORM_RECOGNIZER_CACHE):
+    form_client = form_client or get_form_client()
+    results = analyze_id_document(form_client, id_card, cache=cache)
     return results[0]
 
 
-def get_pii_from_boarding_pass(boarding_pass, form_client=None):
-    if form_client is None:
-        form_client = authenticate_form_client(
-            v.FORM_RECOGNIZER_ENDPOINT, v.FORM_RECOGNIZER_KEY, training=False
-        )
-    
+def get_pii_from_boarding_pass(boarding_pass, form_client=None, cache=FORM_RECOGNIZER_CACHE):
+    form_client = form_client or get_form_client()
     results = analyze_boarding_pass(
         form_client, 
         model_id=v.FORM_RECOGNIZER_TRAINED_MODEL_ID,
-        document=boarding_pass
+        document=boarding_pass,
+        cache=cache
     )
     return results[0]
 
 
-def get_passenger_manifest_info(path):
-    with open(path, "r") as f:
-        reader = csv.reader(f)
-        header = next(reader)
-    
-        passengers = [
-            {clean_text(x): y for x, y in zip(header, row)} for row in reader
-        ]
-    return header, passengers
+async def get_pii_from_id_card_async(id_card, form_client=None, cache=FORM_RECOGNIZER_CACHE, content_key=None):
+    form_client = form_client or get_form_client_async()
+    results = await analyze_id_document_async(form_client, id_card, cache=cache, content_key=content_key)
+    return results[0]
+
+
+async def get_pii_from_boarding_pass_async(
+    boarding_pass, form_client=None, cache=FORM_RECOGNIZER_CACHE, content_key=None
+):
+    form_client = form_client or get_form_client_async()
+    results = await analyze_boarding_pass_async(
+        form_client,
+        model_id=v.FORM_RECOGNIZER_TRAINED_MODEL_ID,
+        document=boarding_pass,
+        cache=cache,
+        content_key=content_key
+    )
+    return results[0]
+
+
+async def resolve_passenger_documents(passenger_documents, container=None, blob_client=None):
+    """
+    Documents of passengers with `from_blob` are blobs named by their paths in `container`.
+    Those are replaced by short-lived read-only SAS URLs that the Azure services fetch themselves,
+    so they are never downloaded or uploaded again.
+
+    :return: `(documents, content_keys)`. `content_keys` maps each URL to the key its results are cached by
+    """
+    documents = {name: passenger_documents[name] for name in DOCUMENT_TYPES}
+    documents["luggage"] = passenger_documents.get("luggage") or []
+    if not passenger_documents.get("from_blob"):
+        return documents, {}
+
+    if not container:
+        msg = "Set `container` in the passengers file to read documents from blob storage"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    blob_client = blob_client or get_blob_service_client()
+    resolved = await asyncio.gather(*[
+        run_blocking(get_blob_document, blob_client, container, documents[name]) for name in DOCUMENT_TYPES
+    ])
+    content_keys = {url: content_key for url, content_key in resolved}
+    resolved_documents = {name: url for name, (url, _) in zip(DOCUMENT_TYPES, resolved)}
+    # Luggage scans are not cached, so their images need no content keys
+    resolved_documents["luggage"] = [get_blob_url(blob_client, container, image) for image in documents["luggage"]]
+    return resolved_documents, content_keys
+
+
+def get_document_name(document):
+    """File name of a local path or URL, without its extension"""
+    return os.path.splitext(os.path.basename(urlparse(document).path))[0]
+
+
+def find_manifest_info(manifest: ManifestStore, boarding_pass_info, id_card_info, flight_no=None):
+    """
+    Manifest row of the passenger named on the boarding pass, or else on the ID card.
+    Names misread by OCR resolve to the closest name on the flight.
+
+    :param flight_no: Flight being boarded. Defaults to the flight on the boarding pass
+    """
+    for document_info in (boarding_pass_info, id_card_info):
+        manifest_info = manifest.find(
+            get_value(document_info["first_name"]),
+            get_value(document_info["last_name"]),
+            flight_no or get_value(document_info.get("flight_no"))
+        )
+        if manifest_info is not None:
+            return manifest_info
+
+    logger.error(f"Passenger with boarding pass: {get_value(boarding_pass_info['source'])} is not in the manifest")
+    return None
 
 
 def validate_name(manifest_info, boarding_pass_info, id_card_info):
     if (
-        clean_text(manifest_info["First Name"]) != clean_text(id_card_info["first_name"])
-        | clean_text(manifest_info["Last Name"]) != clean_text(id_card_info["last_name"])
+        clean_text(manifest_info["First Name"]) != clean_text(get_value(id_card_info["first_name"]))
+        or clean_text(manifest_info["Last Name"]) != clean_text(get_value(id_card_info["last_name"]))
     ):
         return f.PII_MISMATCH_MESSAGE.format(document="ID card")
 
     if (
-        clean_text(manifest_info["First Name"]) != clean_text(boarding_pass_info["first_name"])
-        | clean_text(manifest_info["Last Name"]) != clean_text(boarding_pass_info["last_name"])
+        clean_text(manifest_info["First Name"]) != clean_text(get_value(boarding_pass_info["first_name"]))
+        or clean_text(manifest_info["Last Name"]) != clean_text(get_value(boarding_pass_info["last_name"]))
     ):
         return f.PII_MISMATCH_MESSAGE.format(document="boarding pass")
     
@@ -100,7 +234,7 @@ def validate_name(manifest_info, boarding_pass_info, id_card_info):
 
 
 def validate_dob(manifest_info, id_card_info):
-    if clean_text(manifest_info["DateofBirth"]) != clean_text(id_card_info["date_of_birth"]):
+    if normalize_date(manifest_info["DateofBirth"]) != normalize_date(get_value(id_card_info["date_of_birth"])):
         return f.PII_MISMATCH_MESSAGE.format(document="ID card")
     
     return None
@@ -108,126 +242,452 @@ def validate_dob(manifest_info, id_card_info):
 
 def validate_boarding_pass(manifest_info, boarding_pass_info):
     if (
-        clean_text(manifest_info["Flight No"]) != clean_text(boarding_pass_info["flight_no"])
-        | manifest_info["Origin"] != boarding_pass_info["origin"]
-        | manifest_info["Destination"] != boarding_pass_info["destination"]
-        | manifest_info["Time"] != boarding_pass_info["boarding_time"]
-        | manifest_info["Date"] != boarding_pass_info["date"]
+        clean_text(manifest_info["Flight No"]) != clean_text(get_value(boarding_pass_info["flight_no"]))
+        or clean_text(manifest_info["Origin"]) != clean_text(get_value(boarding_pass_info["origin"]))
+        or clean_text(manifest_info["Destination"]) != clean_text(get_value(boarding_pass_info["destination"]))
+        or normalize_time(manifest_info["Time"]) != normalize_time(get_value(boarding_pass_info["boarding_time"]))
+        or normalize_date(manifest_info["Date"]) != normalize_date(get_value(boarding_pass_info["date"]))
     ):
         return f.FLIGHT_INFO_MISMATCH
     
     return None
 
 
-def validate_person(
+async def report_kiosk_experience(videos, person_video, content_key=None):
+    """Index `person_video` for the sentiments and emotions of the passenger at the kiosk"""
+    _, video_info = await videos.get_index(
+        person_video, video_name=get_document_name(person_video), content_key=content_key
+    )
+    kiosk_experience_insight = get_sentiment_and_emotion(video_info)
+    logger.info(f"Kiosk experience in video: {person_video}: {kiosk_experience_insight}")
+    print(kiosk_experience_insight)
+
+
+async def get_person_frames(person_video, face_client, frame_sampler):
+    """
+    Crops of the passenger's face sampled from `person_video` on the CPU that Face also finds a face in.
+    Empty when no frame qualifies or the video cannot be decoded, so Video Indexer thumbnails are used instead.
+    """
+    try:
+        frames = await run_blocking(frame_sampler.extract, person_video, get_document_name(person_video))
+    except Exception as e:
+        logger.warning(f"Could not sample frames of video: {person_video}: {e}")
+        return []
+
+    detected_faces = await run_blocking(detect_faces_in_images, face_client, frames)
+    return [data for name, data in frames if detected_faces.get(name)]
+
+
+async def match_person(
+    person_video,
+    id_card,
+    face_client,
+    indexer,
+    person_name=None,
+    videos=None,
+    identities=None,
+    identifier=None,
+    content_keys=None,
+    frame_sampler=None,
+    training_timeout=TRAINING_TIMEOUT
+):
+    """
+    Confidence, between 0 and 1, that the person in `person_video` is the person on `id_card`.
+    Needs no manifest information, so it runs while the documents are still being read.
+
+    :param frame_sampler: Take the passenger's face from frames sampled locally by this `FrameSampler`.
+        The video is then indexed by Video Indexer in the background, for its insights only
+    :param training_timeout: Seconds to wait for the identity index to be trained with the passenger
+    """
+    content_keys = content_keys or {}
+    person_name = person_name or get_document_name(id_card)
+    videos = videos or VideoRegistry(indexer)
+
+    if identities is None:
+        with FlightIdentityIndex(face_client, person_name) as identities:
+            return await match_person(
+                person_video, id_card, face_client, indexer, person_name, videos, identities,
+                content_keys=content_keys, frame_sampler=frame_sampler, training_timeout=training_timeout
+            )
+    identifier = identifier or IdentifyBatcher(identities.identify)
+
+    person_images = []
+    if frame_sampler is not None:
+        # Indexing starts right away. Falling back to thumbnails below waits on this same upload
+        videos.run_in_background(report_kiosk_experience(videos, person_video, content_keys.get(person_video)))
+        person_images = await get_person_frames(person_video, face_client, frame_sampler)
+
+    if not person_images:
+        uploaded_video_id, video_info = await videos.get_index(
+            person_video, video_name=get_document_name(person_video), content_key=content_keys.get(person_video)
+        )
+
+        if frame_sampler is None:
+            kiosk_experience_insight = get_sentiment_and_emotion(video_info)
+            print(kiosk_experience_insight)
+
+        # The selected thumbnails go to the identity index as bytes, so passengers sharing a video
+        # never read files that another passenger is writing
+        selected = await run_blocking(select_face_thumbnails, video_info, uploaded_video_id, indexer)
+        person_images = [candidate.data for candidates in selected.values() for candidate in candidates]
+
+    face_in_id_card = await run_blocking(detect_faces, face_client, [id_card], content_keys=content_keys)
+    if not face_in_id_card:
+        logger.warning(f"No face found in ID card: {id_card}")
+        return 0.0
+    face_id = list(face_in_id_card.values())[0]
+
+    person_id, version = await run_blocking(identities.add_person, person_name, person_images)
+    await run_blocking(identities.wait_until_trained, version, training_timeout)
+
+    candidates = await identifier.identify(face_id)
+    confidence = 0.0
+    for candidate in candidates:
+        if candidate.person_id == person_id:
+            confidence = float(candidate.confidence)
+    return confidence
+
+
+def validate_person_confidence(manifest_info, person_confidence, threshold=0.65):
+    if person_confidence <= threshold:
+        return f.FACE_ID_FAILS_MESSAGE.format(
+            first_name=manifest_info["First Name"],
+            last_name=manifest_info["Last Name"],
+            flightno=manifest_info["Flight No"],
+            flight_time=manifest_info["Time"],
+            origin=manifest_info["Origin"],
+            destination=manifest_info["Destination"]
+        )
+    
+    return None
+
+
+async def validate_person(
     manifest_info, 
     person_video, 
     id_card, 
     face_client, 
     indexer, 
     threshold=0.65, 
-    thumbnail_dir="outputs/indexer/thumbnails"
+    videos=None,
+    identities=None,
+    identifier=None,
+    content_keys=None,
+    frame_sampler=None
 ):
-    person_id = f"{manifest_info['First Name']}_{manifest_info['Last Name']}_{time.strftime('%Y%m%d-%H%M%S')}"
-    
-    uploaded_video_id = indexer.upload_video_to_indexer(
-            input_filename=person_video,
-            video_name=f"{person_id}_video",
-            video_language="English"
-        )
-    time.sleep(300)
-
-    face_in_id_card = detect_faces(face_client, [id_card])
-    face_id = list(face_in_id_card.values())[0]
+    confidence = await match_person(
+        person_video,
+        id_card,
+        face_client,
+        indexer,
+        person_name=f"{manifest_info['First Name']}_{manifest_info['Last Name']}",
+        videos=videos,
+        identities=identities,
+        identifier=identifier,
+        content_keys=content_keys,
+        frame_sampler=frame_sampler
+    )
+    return validate_person_confidence(manifest_info, confidence, threshold)
 
-    video_info = indexer.get_video_info(uploaded_video_id, video_language="English")
-    kiosk_experience_insight = get_sentiment_and_emotion(video_info)
-    print(kiosk_experience_insight)
 
-    thumbnails = save_face_thumbnails(
-            video_info, uploaded_video_id, thumbnail_dir, indexer
-            )
-    person_images = [os.path.join(thumbnail_dir, x) for x in thumbnails]
-    create_person_group(face_client, person_id, person_id, person_images)
+async def scan_passenger_luggage(
+    luggage, prediction_client=None, threshold=DETECTION_THRESHOLD, local_detector=None
+):
+    """
+    :return: Verdict on the luggage images of a passenger, with the bounding boxes of prohibited items
+    """
+    if not luggage:
+        return {"prohibited_item_found": False, "detections": []}
+
+    prediction_client = prediction_client or get_prediction_client()
+    verdicts = await scan_luggage_async(
+        prediction_client,
+        {"passenger": luggage},
+        v.CUSTOM_VISION_PROJECT_ID,
+        v.CUSTOM_VISION_DEFAULT_MODEL_ITERATION_NAME,
+        threshold=threshold,
+        local_detector=local_detector
+    )
+    return verdicts["passenger"]
 
-    match_results = match_against_person_group(face_client, [face_id], person_id)
-    for result in match_results:
-        for candidate in result.candidates:
-            confidence = float(candidate.confidence)
 
-    if confidence <= threshold:
-        return f.FACE_ID_FAILS_MESSAGE.format(
+def validate_luggage(manifest_info, luggage_verdict):
+    if luggage_verdict["prohibited_item_found"]:
+        for detection in luggage_verdict["detections"]:
+            logger.warning(
+                f"{detection['tag']} found in luggage of {manifest_info['First Name']} {manifest_info['Last Name']}: "
+                f"{detection['source']} at {detection['bounding_box']}"
+            )
+        return f.LIGHTER_DECTECTED_MESSAGE.format(
             first_name=manifest_info["First Name"],
             last_name=manifest_info["Last Name"],
             flightno=manifest_info["Flight No"],
+            flight_time=manifest_info["Time"],
             origin=manifest_info["Origin"],
             destination=manifest_info["Destination"]
         )
-    
+
     return None
 
 
-def validate_luggage():
-    # TODO: This is not currently in use but will be implemented
-    pass
+def listed_passenger_check(check):
+    """Run `check` on the passenger's manifest row, or fail it when the passenger is not in the manifest"""
+    def run_check(manifest_info, **inputs):
+        if manifest_info is None:
+            return f.PASSENGER_NOT_IN_MANIFEST_MESSAGE
+        return check(manifest_info, **inputs)
+
+    return run_check
 
 
-def validate_passenger(
-    manifest_info, id_card, boarding_pass, person_video, form_client, face_client, indexer
+async def validate_passenger(
+    manifest, id_card, boarding_pass, person_video, form_client, face_client, indexer, videos=None,
+    identities=None, identifier=None, content_keys=None, luggage=None, prediction_client=None,
+    luggage_threshold=DETECTION_THRESHOLD, luggage_detector=None, flight_no=None, frame_sampler=None,
+    journal=None, passenger_key=None
 ):
-    id_card_info = get_pii_from_id_card(id_card, form_client)
-    boarding_pass_info = get_pii_from_boarding_pass(boarding_pass)
-    validated_manifest_info = {**manifest_info}
- 
-    boarding_pass_issue = validate_boarding_pass(manifest_info, boarding_pass_info)
-    if not boarding_pass_issue:
+    """
+    Validate a passenger as a graph of stages. Document OCR and the video/face pipeline
+    do not depend on each other and run at the same time. The passenger is looked up in the
+    manifest by the names read from their documents, and each check starts as soon as the
+    manifest row and the documents it needs are available.
+
+    :param manifest: Manifest of the flight
+    :param flight_no: Flight being boarded, used to look the passenger up in the manifest
+    :return: The passenger's manifest row with the validations that passed set to `True`,
+        or `None` when the passenger is not in the manifest
+
+    :param form_client: Async Form Recognizer client. Document OCR is awaited on the event loop
+        rather than holding an executor thread while Form Recognizer processes the documents
+    :param content_keys: Maps documents passed as URLs to the keys their results are cached by
+    :param luggage: Images of the passenger's carry-on luggage, scanned alongside the other stages
+    :param luggage_detector: Local lighter detector used instead of Custom Vision
+    :param frame_sampler: Take the passenger's face from frames sampled locally instead of waiting
+        on Video Indexer. See `match_person`
+    :param journal: `Journal` that the result of each stage is recorded in under `passenger_key`.
+        Stages with a recorded result are not run again
+    """
+    content_keys = content_keys or {}
+    stages = {
+        "id_card_info": (
+            lambda: get_pii_from_id_card_async(id_card, form_client, content_key=content_keys.get(id_card)), []
+        ),
+        "boarding_pass_info": (
+            lambda: get_pii_from_boarding_pass_async(
+                boarding_pass, form_client, content_key=content_keys.get(boarding_pass)
+            ),
+            []
+        ),
+        "manifest_info": (
+            lambda boarding_pass_info, id_card_info: find_manifest_info(
+                manifest, boarding_pass_info, id_card_info, flight_no
+            ),
+            ["boarding_pass_info", "id_card_info"]
+        ),
+        "person_confidence": (
+            lambda: match_person(
+                person_video, id_card, face_client, indexer,
+                videos=videos, identities=identities, identifier=identifier, content_keys=content_keys,
+                frame_sampler=frame_sampler
+            ),
+            []
+        ),
+        "person_identity_issue": (
+            listed_passenger_check(validate_person_confidence),
+            ["manifest_info", "person_confidence"]
+        ),
+        "boarding_pass_issue": (
+            listed_passenger_check(validate_boarding_pass),
+            ["manifest_info", "boarding_pass_info"]
+        ),
+        "passenger_name_issue": (
+            listed_passenger_check(validate_name),
+            ["manifest_info", "boarding_pass_info", "id_card_info"]
+        ),
+        "passenger_dob_issue": (
+            listed_passenger_check(validate_dob),
+            ["manifest_info", "id_card_info"]
+        ),
+        "luggage_verdict": (
+            lambda: scan_passenger_luggage(luggage, prediction_client, luggage_threshold, luggage_detector), []
+        ),
+        "luggage_issue": (
+            listed_passenger_check(validate_luggage),
+            ["manifest_info", "luggage_verdict"]
+        ),
+    }
+    if journal is not None:
+        stages = journal.wrap_stages(passenger_key, stages)
+    results = await run_stages(stages)
+    if results["manifest_info"] is None:
+        return None
+    validated_manifest_info = {**results["manifest_info"]}
+
+    if not results["boarding_pass_issue"]:
         validated_manifest_info["BoardingPassValidation"] = True
 
-    passenger_name_issue = validate_name(manifest_info, boarding_pass_info, id_card_info)
-    if not passenger_name_issue:
+    if not results["passenger_name_issue"]:
         validated_manifest_info["NameValidation"] = True
-    
-    passenger_dob_issue = validate_dob(manifest_info, id_card_info)
-    if not passenger_dob_issue:
+
+    if not results["passenger_dob_issue"]:
         validated_manifest_info["DoBValidation"] = True
-    
-    person_identity_issue = validate_person(manifest_info, person_video, id_card, face_client, indexer)
-    if not person_identity_issue:
+
+    if not results["person_identity_issue"]:
         validated_manifest_info["PersonValidation"] = True
-    
-    # NOTE: This is not in use because no passenger luggages to validate
-    # All passenger's validation are set to True currrently 
-    # validate_luggage()
-    validated_manifest_info["LuggageValidation"] = True
+
+    if not results["luggage_issue"]:
+        validated_manifest_info["LuggageValidation"] = True
 
     return validated_manifest_info
 
 
-def main():
-    info = yaml.safe_load(open("passengers.yml", "r"))
-    form_client, face_client, indexer, blob_service_client = get_clients()
-
-    header, manifest_info = get_passenger_manifest_info(info["manifest"])
-    manifest_info = sorted(manifest_info, key=lambda x: x["First Name"]+x["Last Name"])
-    validated_manifest_info = []
-
-    for passenger_documents, passenger_info in zip(info["passengers"], manifest_info):
-        validated_passenger_info = validate_passenger(
-            manifest_info=passenger_info,
-            id_card=passenger_documents["id_card"],
-            boarding_pass=passenger_documents["boarding_pass"],
-            person_video=passenger_documents["video"],
+async def validate_passengers(
+    passengers, manifest, face_client, indexer, form_client=None, concurrency=8, videos=None, identities=None,
+    container=None, prediction_client=None, luggage_threshold=DETECTION_THRESHOLD, luggage_detector=None,
+    flight_no=None, frame_sampler=None, journal=None, on_validated=None
+):
+    """
+    Validate passengers with at most `concurrency` of them in flight.
+    The returned list is in the same order as `passengers`, with `None` for passengers not in `manifest`.
+    A passenger whose validation fails is logged and also returned as `None`, so that one failure does not
+    stop the rest of the flight. With a `journal`, failed passengers are validated again on resume.
+
+    :param form_client: Async Form Recognizer client. When not given, the client of the running
+        loop is used and closed once every passenger is validated
+    :param container: Blob container holding the documents of passengers with `from_blob`
+    :param frame_sampler: Take faces from frames sampled locally. Videos are then indexed for their
+        insights in the background, and waited on once every passenger is validated
+    :param journal: `Journal` of stage results. Passengers and stages recorded in it are not validated again
+    :param on_validated: Called with the validated row of each passenger, or `None`, as soon as it is validated
+    """
+    owns_form_client = form_client is None
+    form_client = form_client or get_form_client_async()
+    videos = videos or VideoRegistry(indexer)
+    identifier = IdentifyBatcher(identities.identify) if identities else None
+
+    async def validate(passenger_documents):
+        key = passenger_key(passenger_documents)
+        if journal is not None and journal.has(key, "validated"):
+            validated_manifest_info = journal.get(key, "validated")
+        else:
+            try:
+                validated_manifest_info = await validate_documents(passenger_documents, key)
+            except Exception as e:
+                logger.error(f"Validating passenger with documents: {passenger_documents} failed: {e!r}")
+                return None
+            if journal is not None:
+                journal.record(key, "validated", validated_manifest_info)
+
+        if on_validated is not None:
+            on_validated(validated_manifest_info)
+        return validated_manifest_info
+
+    async def validate_documents(passenger_documents, key):
+        documents, content_keys = await resolve_passenger_documents(passenger_documents, container)
+        return await validate_passenger(
+            manifest=manifest,
+            id_card=documents["id_card"],
+            boarding_pass=documents["boarding_pass"],
+            person_video=documents["video"],
             form_client=form_client,
             face_client=face_client,
-            indexer=indexer
+            indexer=indexer,
+            videos=videos,
+            identities=identities,
+            identifier=identifier,
+            content_keys=content_keys,
+            luggage=documents["luggage"],
+            prediction_client=prediction_client,
+            luggage_threshold=luggage_threshold,
+            luggage_detector=luggage_detector,
+            flight_no=flight_no,
+            frame_sampler=frame_sampler,
+            journal=journal,
+            passenger_key=key
         )
-        validated_manifest_info.append(validated_passenger_info)
 
+    try:
+        validated = await gather_bounded(
+            [functools.partial(validate, documents) for documents in passengers], concurrency=concurrency
+        )
+        await videos.drain()
+        return validated
+    finally:
+        if owns_form_client:
+            await close_async_clients()
+
+
+def main():
+    args = get_parser()
+    info = yaml.safe_load(open(args.passengers, "r"))
+    # Each passenger has up to three requests in flight (two OCR calls and one video/face call)
+    get_session(pool_size=args.concurrency * 3)
+    face_client, indexer = get_face_client(), get_indexer()
+
+    manifest = ManifestStore.load(info["manifest"])
+
+    receiver = None
+    if args.callback_url:
+        receiver = IndexCallbackReceiver(port=args.callback_port, public_url=args.callback_url).start()
+
+    flight_id = info.get("flight") or os.path.splitext(os.path.basename(info["manifest"]))[0]
     validated_manifest_path = info["manifest"].replace("manifest", "validated_manifest")
+    journal_path = os.path.splitext(validated_manifest_path)[0] + "_journal.jsonl"
+
+    with Journal(journal_path, resume=args.resume) as journal, \
+            open(validated_manifest_path, "w") as validated_manifest_file, \
+            FlightIdentityIndex(face_client, flight_id) as identities:
+        writer = csv.DictWriter(validated_manifest_file, fieldnames=manifest.header)
+        writer.writeheader()
+
+        def write_row(row):
+            # Rows are written as passengers finish, so a failed run keeps the passengers it validated
+            if row is not None:
+                writer.writerow(row)
+                validated_manifest_file.flush()
+
+        validated_manifest_info = run(
+            validate_passengers(
+                info["passengers"],
+                manifest,
+                face_client=face_client,
+                indexer=indexer,
+                concurrency=args.concurrency,
+                videos=VideoRegistry(
+                    indexer,
+                    cache=VIDEO_INDEX_CACHE,
+                    receiver=receiver,
+                    indexing_preset=args.indexing_preset,
+                    blob_client=get_blob_service_client() if args.stage_videos else None,
+                    container=info.get("container"),
+                    journal=journal
+                ),
+                identities=identities,
+                container=info.get("container"),
+                luggage_threshold=args.luggage_threshold,
+                luggage_detector=(
+                    get_local_lighter_detector(args.onnx_model) if args.luggage_backend == "onnx" else None
+                ),
+                flight_no=info.get("flight"),
+                frame_sampler=(
+                    load_frame_sampler(sample_rate=args.frame_rate, scene_threshold=args.scene_threshold)
+                    if args.frame_sampling else None
+                ),
+                journal=journal,
+                on_validated=write_row
+            ),
+            # OCR is awaited on the loop. Each passenger holds up to one thread for a video/face call,
+            # one waiting for the identity index to train and one scanning luggage
+            max_workers=args.concurrency * 3
+        )
+    if receiver:
+        receiver.stop()
+
+    # Once every passenger is validated, the rows are put in the order of the passengers
     with open(validated_manifest_path, "w") as f:
-        writer = csv.DictWriter(f, fieldnames=header)
+        writer = csv.DictWriter(f, fieldnames=manifest.header)
         writer.writeheader()
-        writer.writerows(validated_manifest_info)
+        writer.writerows(row for row in validated_manifest_info if row is not None)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,46 @@
 import argparse
+import asyncio
 import io
+import json
 import logging
+import math
 import os
+import secrets
+import tempfile
+import threading
 import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from dataclasses import field
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlencode
+from urllib.parse import urlparse
 
+import requests
+from azure.storage.blob import BlobServiceClient
 from PIL import Image
+from PIL import UnidentifiedImageError
 from video_indexer import VideoIndexer
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from ofurufu.blob import DEFAULT_MAX_CONCURRENCY
+from ofurufu.blob import authenticate_blob_client
+from ofurufu.blob import get_blob_url
+from ofurufu.blob import upload_blob
+from ofurufu.cache import DiskCache
+from ofurufu.cache import content_hash
+from ofurufu.cache import file_hash
+from ofurufu.scheduler import map_bounded
+from ofurufu.scheduler import run
+from ofurufu.scheduler import run_blocking
+from ofurufu.throttling import THROTTLED_STATUS_CODES
+from ofurufu.throttling import throttled_call
 from ofurufu.variables import Variables
 
 logging.basicConfig(
@@ -19,6 +53,33 @@ logger = logging.getLogger(__name__)
 
 v = Variables()
 
+VIDEOS_URL = "https://api.videoindexer.ai/{location}/Accounts/{account_id}/Videos"
+INDEXING_DONE_STATE = "Processed"
+INDEXING_FAILED_STATES = ("Failed", "Quarantined")
+CALLBACK_PATH = "/video-indexer/callback"
+# https://docs.microsoft.com/en-us/azure/azure-video-analyzer/video-analyzer-for-media-docs/upload-index-videos
+# "VideoOnly" extracts faces without transcribing audio, so it is faster but gives no sentiments or emotions.
+# "Default" is the fastest preset with both faces and sentiments
+INDEXING_PRESETS = ("Default", "VideoOnly", "AudioOnly", "BasicAudio", "Advanced", "AdvancedVideo", "AdvancedAudio")
+# Blob directory that videos are staged in before being indexed by URL
+VIDEO_BLOB_PREFIX = "videos"
+THUMBNAIL_CHUNK_SIZE = 64 * 1024
+# Paths of the index objects kept in `VideoInsights`
+INDEX_FACES_PATH = "videos.item.insights.faces.item"
+INDEX_SENTIMENTS_PATH = "summarizedInsights.sentiments.item"
+INDEX_EMOTIONS_PATH = "summarizedInsights.emotions.item"
+_ijson_warning_logged = False
+FACE_FIELDS = ("id", "name", "confidence", "seenDuration", "thumbnails")
+# Each face added to a person group is an API call and lengthens training, so only the best few are kept
+MAX_THUMBNAILS_PER_FACE = 5
+# Thumbnails fetched and ranked per selected thumbnail
+CANDIDATES_PER_THUMBNAIL = 4
+DHASH_SIZE = 8
+# Thumbnails whose hashes differ in at most this many of their 64 bits are near-duplicates
+DHASH_MAX_DISTANCE = 10
+# Weight of the time spread against the quality of a thumbnail when selecting thumbnails
+SPREAD_WEIGHT = 0.3
+
 
 def get_parser():
     parser = argparse.ArgumentParser()
@@ -28,6 +89,19 @@ def get_parser():
     parser.add_argument("--video-path")
     parser.add_argument("--video-id")
     parser.add_argument("--thumbnail-dir", default="outputs/indexer/thumbnails")
+    parser.add_argument(
+        "--max-thumbnails", type=int, default=MAX_THUMBNAILS_PER_FACE, help="Best thumbnails to keep. 0 keeps all"
+    )
+    parser.add_argument("--thumbnail-workers", type=int, default=8, help="Thumbnails downloaded at the same time")
+    parser.add_argument("--index-timeout", type=float, default=900, help="Seconds to wait for indexing")
+    parser.add_argument("--indexing-preset", choices=INDEXING_PRESETS, default="Default")
+    parser.add_argument(
+        "--container", help="Stage the video in this blob container and index it by URL instead of uploading it"
+    )
+    parser.add_argument(
+        "--callback-url", help="Public URL forwarded to the local callback receiver. Disables polling"
+    )
+    parser.add_argument("--callback-port", type=int, default=8765)
 
     args = parser.parse_args()
     return args
@@ -44,41 +118,820 @@ def authenticate_video_indexer(subscription_id, location, account_id):
     return indexer
 
 
-def save_face_thumbnails(video_info, video_id: str, thumbnail_dir: str, indexer: VideoIndexer):
-    images = []
-    img_raw = []
-    img_strs = []
-    thumbnail_filenames = []
+def get_videos_url(indexer: VideoIndexer) -> str:
+    """Videos endpoint of the account of `indexer`. Indexers with a `videos_url`, such as `FakeVideoIndexer`, override it"""
+    return getattr(indexer, "videos_url", None) or VIDEOS_URL.format(
+        location=indexer.vi_location, account_id=indexer.vi_account_id
+    )
+
+
+class IndexCallbackReceiver:
+    """
+    Local HTTP receiver for Video Indexer callbacks.
+
+    Video Indexer calls the `callbackUrl` passed on upload with `id` and `state` query
+    parameters whenever the state of a video changes. The receiver resolves a future per
+    video once it reaches a final state, so any number of passengers can wait on their
+    videos without polling.
+
+    Each upload gets its own callback URL from `new_callback_url`, with a secret token that
+    callbacks must carry. Once the upload returns, `bind` ties the token to the id of the video.
+    Callbacks only end a wait early: the state of the video is then read from its index.
+
+    :param host: Interface to listen on. Expose the receiver through `public_url` rather than on all interfaces
+    :param port: Port to listen on. `0` picks a free port
+    :param public_url: URL at which Video Indexer can reach this receiver, e.g. a tunnel
+        or reverse proxy. Defaults to the local address
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, public_url: str = None):
+        self._futures = {}
+        # Callback token of each upload, mapped to the id of its video once the upload returns
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+        local_url = f"http://{'localhost' if host == '0.0.0.0' else host}:{self._server.server_address[1]}"
+        self.public_url = (public_url or local_url).rstrip("/")
+
+    def new_callback_url(self) -> str:
+        """Callback URL for one upload, with a token that only this upload's callbacks carry"""
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            self._tokens[token] = None
+        return f"{self.public_url}{CALLBACK_PATH}?{urlencode({'token': token})}"
+
+    def bind(self, callback_url: str, video_id: str):
+        """Only accept callbacks for `video_id` with the token of `callback_url`"""
+        token = parse_qs(urlparse(callback_url).query)["token"][0]
+        with self._lock:
+            self._tokens[token] = video_id
+
+    def is_authorized(self, token: str, video_id: str) -> bool:
+        with self._lock:
+            if token not in self._tokens:
+                return False
+            bound_video_id = self._tokens[token]
+        return bound_video_id is None or bound_video_id == video_id
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Listening for Video Indexer callbacks on port {self._server.server_address[1]}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def future(self, video_id: str) -> Future:
+        """
+        Future resolved with the final indexing state of `video_id`. Callbacks that arrive
+        before anyone waits are kept, so there is no race with the upload.
+        """
+        with self._lock:
+            if video_id not in self._futures:
+                self._futures[video_id] = Future()
+            return self._futures[video_id]
+
+    async def wait(self, video_id: str, timeout: float = None) -> str:
+        try:
+            state = await asyncio.wait_for(asyncio.wrap_future(self.future(video_id)), timeout)
+        except asyncio.TimeoutError:
+            msg = f"No indexing callback for video: {video_id} within {timeout} seconds"
+            logger.error(msg)
+            raise TimeoutError(msg)
+        finally:
+            with self._lock:
+                self._futures.pop(video_id, None)
+                for token in [token for token, bound in self._tokens.items() if bound == video_id]:
+                    del self._tokens[token]
+        return state
+
+    def notify(self, video_id: str, state: str):
+        logger.info(f"Callback received for video: {video_id} with state: {state}")
+        if state == INDEXING_DONE_STATE or state in INDEXING_FAILED_STATES:
+            future = self.future(video_id)
+            if not future.done():
+                future.set_result(state)
+
+    def _make_handler(self):
+        receiver = self
+
+        class CallbackHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path != CALLBACK_PATH or "id" not in query or "state" not in query:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                if not receiver.is_authorized(query.get("token", [None])[0], query["id"][0]):
+                    logger.warning(f"Rejected callback without a valid token for video: {query['id'][0]}")
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+
+                receiver.notify(query["id"][0], query["state"][0])
+                self.send_response(200)
+                self.end_headers()
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return CallbackHandler
+
+
+def upload_video(
+        indexer: VideoIndexer,
+        video_name: str,
+        video_path: str = None,
+        video_url: str = None,
+        video_language: str = "English",
+        indexing_preset: str = "Default",
+        streaming_preset: str = "Default",
+        callback_url: str = None
+) -> str:
+    """
+    Upload a video file, or a video by URL, to Video Indexer.
+    Unlike `VideoIndexer.upload_to_video_indexer`, this can register a `callback_url`.
+
+    :return: ID of the uploaded video
+    """
+    if not (video_path or video_url):
+        msg = "Pass in `video_path` or `video_url` of video to be uploaded"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    if indexing_preset not in INDEXING_PRESETS:
+        msg = f"`indexing_preset` must be one of {INDEXING_PRESETS}"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    indexer.check_access_token()
+    params = {
+        "name": video_name,
+        "language": video_language,
+        "indexingPreset": indexing_preset,
+        "streamingPreset": streaming_preset,
+        "accessToken": indexer.access_token
+    }
+    if video_url:
+        params["videoUrl"] = video_url
+    if callback_url:
+        params["callbackUrl"] = callback_url
+
+    url = get_videos_url(indexer)
+
+    def post():
+        if video_path:
+            with open(video_path, "rb") as video:
+                response = requests.post(url, params=params, files={"file": video})
+        else:
+            response = requests.post(url, params=params)
+
+        if response.status_code in THROTTLED_STATUS_CODES:
+            response.raise_for_status()
+        return response
+
+    response = throttled_call("video_indexer", post)
+
+    if response.status_code != 200:
+        msg = f"Error uploading video: {video_name} to indexer: {response.text}"
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+    video_id = response.json()["id"]
+    logger.info(f"Uploaded video: {video_name} with id: {video_id}")
+    return video_id
+
+
+def upload_video_from_blob(
+        indexer: VideoIndexer,
+        blob_client: BlobServiceClient,
+        container: str,
+        video_path: str,
+        video_name: str,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        **kwargs
+) -> str:
+    """
+    Stage a video in blob storage with a parallel block upload, then index it by URL.
+    Unlike a direct upload, a failed block is retried on its own rather than resending the video.
+
+    Staged videos are named by content, so a video that is already staged is not uploaded again.
+
+    :param max_concurrency: Blocks uploaded at the same time
+    :param kwargs: Passed on to `upload_video`
+    :return: ID of the uploaded video
+    """
+    blob_name = f"{VIDEO_BLOB_PREFIX}/{file_hash(video_path)}{os.path.splitext(video_path)[1]}"
+    if throttled_call("blob", blob_client.get_blob_client(container, blob_name).exists):
+        logger.info(f"Video: {video_path} is already staged as: {blob_name}")
+    else:
+        upload_blob(
+            video_path, container, blob_client, dest_path=blob_name, overwrite=True, max_concurrency=max_concurrency
+        )
+        logger.info(f"Staged video: {video_path} as: {blob_name}")
+
+    return upload_video(indexer, video_name, video_url=get_blob_url(blob_client, container, blob_name), **kwargs)
+
+
+@dataclass
+class VideoInsights:
+    """
+    The parts of a video index that are used: its faces, sentiments and emotions.
+    Transcripts, OCR, keyframes and the other insights of the index are left out.
+
+    :param faces: Faces of the video with only their `FACE_FIELDS`
+    :param sentiments: `summarizedInsights.sentiments` of the index
+    :param emotions: `summarizedInsights.emotions` of the index
+    """
+    video_id: str
+    state: str
+    faces: list = field(default_factory=list)
+    sentiments: list = field(default_factory=list)
+    emotions: list = field(default_factory=list)
+
+    def __str__(self):
+        return (
+            f"Video: {self.video_id} in state: {self.state} with {len(self.faces)} faces, "
+            f"{len(self.sentiments)} sentiments and {len(self.emotions)} emotions"
+        )
+
+
+def _compact_face(face) -> dict:
+    return {key: face[key] for key in FACE_FIELDS if key in face}
+
+
+def to_video_insights(video_info) -> VideoInsights:
+    """`VideoInsights` of a full video index, as returned by `VideoIndexer.get_video_info`"""
+    if isinstance(video_info, VideoInsights):
+        return video_info
+    summarized = video_info.get("summarizedInsights") or {}
+    return VideoInsights(
+        video_id=video_info.get("id"),
+        state=video_info.get("state"),
+        faces=[
+            _compact_face(face) for video in video_info.get("videos", [])
+            for face in video.get("insights", {}).get("faces", [])
+        ],
+        sentiments=summarized.get("sentiments", []),
+        emotions=summarized.get("emotions", [])
+    )
+
+
+def parse_video_index(stream) -> VideoInsights:
+    """
+    `VideoInsights` of the video index in the JSON byte `stream`.
+    The index is parsed incrementally and only the objects of `VideoInsights` are built, so memory
+    does not grow with the length of the video. Parsing stops early for videos that are not indexed yet.
+    Without `ijson`, the whole index is loaded first.
+    """
+    global _ijson_warning_logged
+    if ijson is None:
+        if not _ijson_warning_logged:
+            logger.warning("`ijson` is not installed, so video indexes are loaded whole. Install it to stream them")
+            _ijson_warning_logged = True
+        return to_video_insights(json.load(stream))
+
+    insights = VideoInsights(video_id=None, state=None)
+    targets = {
+        INDEX_FACES_PATH: insights.faces,
+        INDEX_SENTIMENTS_PATH: insights.sentiments,
+        INDEX_EMOTIONS_PATH: insights.emotions
+    }
+    builder, target = None, None
+
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == target and event == "end_map":
+                item = _compact_face(builder.value) if target == INDEX_FACES_PATH else builder.value
+                targets[target].append(item)
+                builder = None
+        elif event == "start_map" and prefix in targets:
+            builder, target = ijson.ObjectBuilder(), prefix
+            builder.event(event, value)
+        elif prefix == "id":
+            insights.video_id = value
+        elif prefix == "state":
+            insights.state = value
+            if value != INDEXING_DONE_STATE:
+                # The index holds no insights until the video is processed
+                break
+
+    return insights
+
+
+def get_video_insights(indexer: VideoIndexer, video_id: str, video_language: str = "English") -> VideoInsights:
+    """
+    Lean alternative to `VideoIndexer.get_video_info`: streams the index of a video through
+    `parse_video_index` rather than loading all of it
+    """
+    indexer.check_access_token()
+    url = f"{get_videos_url(indexer)}/{video_id}/Index"
+    params = {"language": video_language, "accessToken": indexer.access_token}
+
+    def get():
+        with requests.get(url, params=params, stream=True) as response:
+            if response.status_code in THROTTLED_STATUS_CODES:
+                response.raise_for_status()
+            if response.status_code != 200:
+                msg = f"Error getting index of video: {video_id}: {response.text}"
+                logger.error(msg)
+                raise RuntimeError(msg)
+
+            response.raw.decode_content = True
+            return parse_video_index(response.raw)
+
+    return throttled_call("video_indexer", get)
+
+
+async def wait_for_index(
+        indexer: VideoIndexer,
+        video_id: str,
+        video_language: str = "English",
+        timeout: float = 900,
+        initial_interval: float = 5,
+        max_interval: float = 60,
+        backoff: float = 1.5,
+        receiver: IndexCallbackReceiver = None,
+        callback_timeout: float = None
+) -> VideoInsights:
+    """
+    Poll the processing state of an uploaded video until indexing is done.
+    The poll interval grows by `backoff` up to `max_interval`, and the event loop
+    is free to run other passengers between polls.
+
+    With a `receiver`, the video must have been uploaded with a URL from `receiver.new_callback_url`.
+    There is then no polling until the callback arrives. The index is fetched once the callback
+    arrives, and polling only resumes if the index is not processed yet. A callback that never
+    arrives, say because the tunnel to the receiver is down, only costs `callback_timeout` seconds:
+    the video is then polled for until the deadline.
+
+    :param timeout: Seconds to wait before giving up on the video
+    :param callback_timeout: Seconds of `timeout` to wait on the callback before polling. Defaults to half of `timeout`
+    :return: `VideoInsights` of the video once it is processed
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    interval = initial_interval
 
+    if receiver is not None:
+        if callback_timeout is None:
+            callback_timeout = timeout / 2
+        try:
+            callback_state = await receiver.wait(video_id, min(callback_timeout, timeout))
+        except TimeoutError:
+            logger.warning(f"No indexing callback for video: {video_id}. Polling its index instead")
+            receiver = None
+
+    while True:
+        video_info = await run_blocking(get_video_insights, indexer, video_id, video_language)
+        state = video_info.state
+
+        if state == INDEXING_DONE_STATE:
+            logger.info(f"Video: {video_id} indexed")
+            return video_info
+        if receiver is not None and callback_state != state:
+            logger.warning(
+                f"Callback reported video: {video_id} in state: {callback_state}, but its index is in state: {state}"
+            )
+            receiver = None
+        if state in INDEXING_FAILED_STATES:
+            msg = f"Indexing video: {video_id} ended in state: {state}"
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            msg = f"Video: {video_id} was not indexed within {timeout} seconds. Last state: {state}"
+            logger.error(msg)
+            raise TimeoutError(msg)
+
+        logger.info(f"Video: {video_id} is in state: {state}. Checking again in {interval:.0f} seconds")
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
+
+
+class VideoRegistry:
+    """
+    Uploads and indexes each distinct video once.
+
+    Videos are fingerprinted by content. A video whose content was indexed before reuses the
+    indexed `video_id` and its index from `cache`. Requests for a video that is still being
+    uploaded or indexed wait on that upload instead of starting another, so uploads and
+    indexing waits scale with the number of distinct videos rather than with passengers.
+
+    :param cache: Persists `(video_id, video_info)` per fingerprint across runs
+    :param receiver: Wait on indexing callbacks instead of polling
+    :param indexing_preset: One of `INDEXING_PRESETS`
+    :param blob_client: With `container`, local videos are staged in blob storage and indexed by URL
+    :param journal: `Journal` that the ids of uploaded videos are recorded in. Videos uploaded by a run
+        that failed before they were indexed are waited on rather than uploaded again
+
+    Jobs off the critical path, such as indexing videos only for their insights, are started with
+    `run_in_background` and awaited with `drain`.
+    """
+    def __init__(
+            self,
+            indexer: VideoIndexer,
+            cache: DiskCache = None,
+            receiver: IndexCallbackReceiver = None,
+            video_language: str = "English",
+            index_timeout: float = 900,
+            indexing_preset: str = "Default",
+            blob_client: BlobServiceClient = None,
+            container: str = None,
+            journal=None
+    ):
+        self.indexer = indexer
+        self.cache = cache
+        self.receiver = receiver
+        self.video_language = video_language
+        self.index_timeout = index_timeout
+        self.indexing_preset = indexing_preset
+        self.blob_client = blob_client
+        self.container = container
+        self.journal = journal
+        self._fingerprints = {}
+        self._in_flight = {}
+        self._background = set()
+
+    async def fingerprint(self, video_path: str) -> str:
+        stat = os.stat(video_path)
+        file_key = (os.path.abspath(video_path), stat.st_size, stat.st_mtime)
+        if file_key not in self._fingerprints:
+            self._fingerprints[file_key] = await run_blocking(file_hash, video_path)
+        return self._fingerprints[file_key]
+
+    async def get_index(self, video_path: str, video_name: str, content_key: str = None) -> tuple:
+        """
+        :param video_path: Local path or URL of the video. Video Indexer downloads URLs itself
+        :param content_key: Identifies the content of a video URL, e.g. the MD5 of a blob.
+            URLs without a key are only deduplicated within the run and not cached
+        :return: `(video_id, video_info)` of the indexed video
+        """
+        is_url = any([video_path.startswith("http"), video_path.startswith("www.")])
+        if content_key is not None:
+            fingerprint = content_key
+        elif is_url:
+            # Drop the SAS token, which differs between URLs of the same blob
+            fingerprint = video_path.split("?")[0]
+        else:
+            fingerprint = await self.fingerprint(video_path)
+        key = content_hash(fingerprint, self.video_language, self.indexing_preset)
+        cache = self.cache if content_key is not None or not is_url else None
+
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                logger.info(f"Reusing indexed video: {cached[0]} for: {video_path}")
+                return cached
+
+        if key not in self._in_flight:
+            self._in_flight[key] = asyncio.ensure_future(self._index(key, video_path, video_name, cache))
+        else:
+            logger.info(f"Waiting on in-flight upload of: {video_path}")
+        return await asyncio.shield(self._in_flight[key])
+
+    def run_in_background(self, coroutine):
+        """Run `coroutine`, e.g. indexing a video for its insights, without anyone waiting on it"""
+        task = asyncio.ensure_future(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def drain(self):
+        """Wait for the jobs started with `run_in_background`. Call before the event loop stops"""
+        while self._background:
+            for result in await asyncio.gather(*self._background, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.error(f"Background video job failed: {result}")
+
+    async def _index(self, key, video_path, video_name, cache):
+        is_url = any([video_path.startswith("http"), video_path.startswith("www.")])
+        upload_kwargs = {
+            "video_name": video_name,
+            "video_language": self.video_language,
+            "indexing_preset": self.indexing_preset,
+            "callback_url": self.receiver.new_callback_url() if self.receiver else None
+        }
+        receiver = self.receiver
+        resumed = self.journal is not None and self.journal.has(key, "video_id")
+        try:
+            if resumed:
+                video_id = self.journal.get(key, "video_id")
+                logger.info(f"Resuming indexing of video: {video_id} for: {video_path}")
+                # The video may have been indexed while nobody listened for its callback, so it is polled
+                receiver = None
+            elif is_url:
+                video_id = await run_blocking(upload_video, self.indexer, video_url=video_path, **upload_kwargs)
+            elif self.blob_client is not None and self.container:
+                video_id = await run_blocking(
+                    upload_video_from_blob, self.indexer, self.blob_client, self.container, video_path,
+                    **upload_kwargs
+                )
+            else:
+                video_id = await run_blocking(upload_video, self.indexer, video_path=video_path, **upload_kwargs)
+            if self.journal is not None and not resumed:
+                self.journal.record(key, "video_id", video_id)
+            if receiver is not None:
+                receiver.bind(upload_kwargs["callback_url"], video_id)
+
+            video_info = await wait_for_index(
+                self.indexer,
+                video_id,
+                self.video_language,
+                timeout=self.index_timeout,
+                receiver=receiver
+            )
+            # Only processed indexes are kept, so a video indexed partway is never reused
+            if cache is not None and video_info.state == INDEXING_DONE_STATE:
+                cache.set(key, (video_id, video_info))
+            return video_id, video_info
+        finally:
+            del self._in_flight[key]
+
+
+def get_faces(video_info) -> list:
+    """Faces in the index of a video, longest seen first. The first face is taken to be the passenger"""
+    return sorted(to_video_insights(video_info).faces, key=lambda face: face.get('seenDuration', 0), reverse=True)
+
+
+def get_face_thumbnails(video_info) -> list:
+    """Thumbnails of the face seen the longest in a video"""
+    faces = get_faces(video_info)
+    if not faces:
+        logger.warning(f"No faces in video: {to_video_insights(video_info).video_id}")
+        return []
+    return faces[0]['thumbnails']
+
+
+def to_seconds(timestamp: str) -> float:
+    """Seconds from the start of a video of a Video Indexer timestamp, e.g. `0:01:02.5`"""
+    seconds = 0.0
+    for part in str(timestamp).split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+@dataclass
+class ThumbnailCandidate:
+    """
+    :param time: Seconds into the video at which the thumbnail was taken
+    :param confidence: Confidence of Video Indexer in the face
+    :param data: JPEG bytes of the thumbnail, once fetched
+    :param size: Pixels in the thumbnail, once fetched. Larger faces make better training images
+    :param dhash: Difference hash of the thumbnail, once fetched
+    """
+    face_id: int
+    thumbnail_id: str
+    file_name: str
+    time: float
+    confidence: float = 1.0
+    data: bytes = None
+    size: int = 0
+    dhash: int = None
+
+
+def get_thumbnail_candidates(face) -> list:
+    candidates = []
+    for thumb in face.get('thumbnails', []):
+        instance = (thumb.get('instances') or [{}])[0]
+        candidates.append(ThumbnailCandidate(
+            face_id=face.get('id'),
+            thumbnail_id=thumb['id'],
+            file_name=thumb['fileName'],
+            time=to_seconds(instance.get('adjustedStart') or instance.get('start') or 0),
+            confidence=thumb.get('confidence', face.get('confidence')) or 1.0
+        ))
+    return sorted(candidates, key=lambda candidate: candidate.time)
+
+
+def spread_over_time(candidates: list, n: int) -> list:
+    """`n` of the time-ordered `candidates`, evenly spaced over the video"""
+    if len(candidates) <= n:
+        return candidates
+    step = (len(candidates) - 1) / max(n - 1, 1)
+    return [candidates[round(i * step)] for i in range(n)]
+
+
+def dhash(data: bytes, hash_size: int = DHASH_SIZE) -> int:
+    """
+    Difference hash of an image: one bit per pair of horizontally adjacent pixels of a small
+    grayscale copy. Near-duplicate images differ in only a few bits
+    """
+    img = Image.open(io.BytesIO(data))
+    # JPEGs are decoded straight to a reduced scale, which is much cheaper than a full decode
+    img.draft("L", (hash_size * 4, hash_size * 4))
+    pixels = list(img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def select_thumbnails(candidates: list, k: int, max_distance: int = DHASH_MAX_DISTANCE) -> list:
+    """
+    Up to `k` fetched thumbnails of a face that are good and different from each other.
+
+    Thumbnails are ranked by the confidence in the face and the size of the thumbnail. Each pick
+    after the first also favours thumbnails far in time from those already picked, and thumbnails
+    within `max_distance` bits of the hash of a picked thumbnail are dropped as near-duplicates.
+
+    :return: The selected candidates in the order they appear in the video
+    """
+    candidates = [candidate for candidate in candidates if candidate.dhash is not None]
+    if not candidates:
+        return []
+
+    largest = max(candidate.size for candidate in candidates) or 1
+    times = [candidate.time for candidate in candidates]
+    duration = (max(times) - min(times)) or 1.0
+    quality = {
+        id(candidate): candidate.confidence * math.sqrt(candidate.size / largest) for candidate in candidates
+    }
+
+    def score(candidate, selected):
+        if not selected:
+            return quality[id(candidate)]
+        spread = min(abs(candidate.time - other.time) for other in selected) / duration
+        return (1 - SPREAD_WEIGHT) * quality[id(candidate)] + SPREAD_WEIGHT * spread
+
+    selected = []
+    remaining = list(candidates)
+    while remaining and len(selected) < k:
+        best = max(remaining, key=lambda candidate: score(candidate, selected))
+        remaining.remove(best)
+        if any(bin(best.dhash ^ other.dhash).count("1") <= max_distance for other in selected):
+            logger.info(f"Dropped near-duplicate thumbnail: {best.file_name}")
+            continue
+        selected.append(best)
+
+    return sorted(selected, key=lambda candidate: candidate.time)
+
+
+def select_face_thumbnails(
+        video_info,
+        video_id: str,
+        indexer: VideoIndexer,
+        k: int = MAX_THUMBNAILS_PER_FACE,
+        max_workers: int = 8,
+        all_faces: bool = False
+) -> dict:
+    """
+    Select the best `k` thumbnails of the passenger, or of every face with `all_faces`, with `select_thumbnails`.
+    Only `CANDIDATES_PER_THUMBNAIL * k` thumbnails per face, spread over the video, are fetched to be ranked.
+
+    :return: Maps the id of each face to its selected `ThumbnailCandidate`s, with their `data`
+    """
+    faces = get_faces(video_info)
+    if not all_faces:
+        faces = faces[:1]
+
+    candidates = {
+        face.get('id'): spread_over_time(get_thumbnail_candidates(face), CANDIDATES_PER_THUMBNAIL * k)
+        for face in faces
+    }
+    logger.info(
+        f"Ranking {sum(len(c) for c in candidates.values())} thumbnails of {len(faces)} faces in video: {video_id}"
+    )
+
+    def fetch(candidate):
+        data = fetch_thumbnail(indexer, video_id, candidate.thumbnail_id)
+        try:
+            img = Image.open(io.BytesIO(data))
+            candidate.data, candidate.size, candidate.dhash = data, img.width * img.height, dhash(data)
+        except (UnidentifiedImageError, OSError):
+            logger.warning(f"Thumbnail: {candidate.file_name} of video: {video_id} is not an image")
+
+    indexer.check_access_token()
+    all_candidates = [candidate for face_candidates in candidates.values() for candidate in face_candidates]
+    for _ in map_bounded(fetch, all_candidates, max_workers):
+        pass
+
+    return {face_id: select_thumbnails(face_candidates, k) for face_id, face_candidates in candidates.items()}
+
+
+def write_atomic(path: str, chunks):
+    """
+    Write `chunks` of bytes to `path` through a temporary file of its own, then rename it into place.
+    Readers never see a partial file, even when several writers save the same thumbnail at once
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def fetch_thumbnail(indexer: VideoIndexer, video_id: str, thumbnail_id: str, path: str = None):
+    """
+    Download a thumbnail as the JPEG encoded by Video Indexer.
+    With `path`, the thumbnail is streamed to disk without being held in memory.
+
+    :return: `path`, or the bytes of the thumbnail when no `path` is given
+    """
+    url = f"{get_videos_url(indexer)}/{video_id}/Thumbnails/{thumbnail_id}"
+    params = {"format": "Jpeg", "accessToken": indexer.access_token}
+
+    def get():
+        with requests.get(url, params=params, stream=True) as response:
+            if response.status_code in THROTTLED_STATUS_CODES:
+                response.raise_for_status()
+            if response.status_code != 200:
+                msg = f"Error getting thumbnail: {thumbnail_id} of video: {video_id}: {response.text}"
+                logger.error(msg)
+                raise RuntimeError(msg)
+
+            if path is None:
+                return response.content
+            write_atomic(path, response.iter_content(chunk_size=THUMBNAIL_CHUNK_SIZE))
+            return path
+
+    return throttled_call("video_indexer", get)
+
+
+def iter_face_thumbnails(video_info, video_id: str, indexer: VideoIndexer, max_workers: int = 8):
+    """
+    Fetch the face thumbnails of a video, `max_workers` at a time, without writing them to disk.
+
+    :return: Generator of `(file_name, jpeg_bytes)` in the order the thumbnails arrive
+    """
+    indexer.check_access_token()
+    thumbnails = get_face_thumbnails(video_info)
+    logger.info(f"Getting {len(thumbnails)} thumbnails in video: {video_id}")
+
+    fetched = map_bounded(
+        lambda thumb: fetch_thumbnail(indexer, video_id, thumb['id']), thumbnails, max_workers
+    )
+    for thumb, data in fetched:
+        yield thumb['fileName'], data
+
+
+def save_face_thumbnails(
+        video_info,
+        video_id: str,
+        thumbnail_dir: str,
+        indexer: VideoIndexer,
+        max_workers: int = 8,
+        max_thumbnails: int = MAX_THUMBNAILS_PER_FACE
+) -> list:
+    """
+    Download thumbnails of the passenger to `thumbnail_dir`, `max_workers` at a time.
+    Thumbnails are written as received from Video Indexer.
+
+    :param max_thumbnails: Keep the best thumbnails chosen by `select_face_thumbnails`.
+        `None` downloads every thumbnail, skipping those already on disk
+    :return: File names of the thumbnails, in the order of the video
+    """
     os.makedirs(thumbnail_dir, exist_ok=True)
 
-    thumbnails = video_info['videos'][0]['insights']['faces'][0]['thumbnails']
+    if max_thumbnails is not None:
+        selected = select_face_thumbnails(video_info, video_id, indexer, k=max_thumbnails, max_workers=max_workers)
+        thumbnails = [candidate for face_candidates in selected.values() for candidate in face_candidates]
+        for candidate in thumbnails:
+            path = os.path.join(thumbnail_dir, candidate.file_name)
+            if not os.path.exists(path):
+                write_atomic(path, [candidate.data])
+        logger.info(f"Saved {len(thumbnails)} selected thumbnails of video: {video_id}")
+        return [candidate.file_name for candidate in thumbnails]
 
-    logger.info(f"Getting thumbnails in video: {video_id}")
+    indexer.check_access_token()
+    thumbnails = get_face_thumbnails(video_info)
+    missing = [thumb for thumb in thumbnails if not os.path.exists(os.path.join(thumbnail_dir, thumb['fileName']))]
 
-    for thumb in thumbnails:
-        logger.info(thumb)
-        thumbnail_filenames.append(thumb['fileName'])
-        thumbnail_id = thumb['id']
-        img_code = indexer.get_thumbnail_from_video_indexer(video_id, thumbnail_id)
+    logger.info(f"Getting {len(missing)} of {len(thumbnails)} thumbnails in video: {video_id}")
 
-        img_strs.append(img_code)
-        img_stream = io.BytesIO(img_code)
-        img_raw.append(img_stream)
-        img = Image.open(img_stream)
-        images.append(img)
+    def fetch(thumb):
+        return fetch_thumbnail(indexer, video_id, thumb['id'], os.path.join(thumbnail_dir, thumb['fileName']))
 
-    for filename, image in zip(thumbnail_filenames, images):
-        image.save(f"{thumbnail_dir}/{filename}")
+    for _, path in map_bounded(fetch, missing, max_workers):
+        logger.info(f"Saved thumbnail: {path}")
 
-    return thumbnail_filenames
+    return [thumb['fileName'] for thumb in thumbnails]
 
 
 def get_sentiment_and_emotion(video_info):
-    return {
-        "sentiments": video_info['summarizedInsights']['sentiments'],
-        "emotions": video_info['summarizedInsights']["emotions"]
-    }
+    # Presets without audio insights, e.g. "VideoOnly", leave these out of the index
+    insights = to_video_insights(video_info)
+    return {"sentiments": insights.sentiments, "emotions": insights.emotions}
 
 
 def main():
@@ -93,19 +946,41 @@ def main():
     
     if args.upload_video:
         logger.info(f"Uploading video: {args.video_path} to indexer")
-        uploaded_video_id = indexer.upload_to_video_indexer(
-            input_filename=args.video_path,
-            video_name=args.video_name,
-            video_language=args.video_language
+        receiver = None
+        if args.callback_url:
+            receiver = IndexCallbackReceiver(port=args.callback_port, public_url=args.callback_url).start()
+
+        upload_kwargs = {
+            "video_name": args.video_name,
+            "video_language": args.video_language,
+            "indexing_preset": args.indexing_preset,
+            "callback_url": receiver.new_callback_url() if receiver else None
+        }
+        if args.container:
+            blob_client = authenticate_blob_client(v.BLOB_ACCOUNT_NAME, v.BLOB_ACCOUNT_KEY)
+            uploaded_video_id = upload_video_from_blob(
+                indexer, blob_client, args.container, args.video_path, **upload_kwargs
+            )
+        else:
+            uploaded_video_id = upload_video(indexer, video_path=args.video_path, **upload_kwargs)
+        if receiver:
+            receiver.bind(upload_kwargs["callback_url"], uploaded_video_id)
+        video_info = run(
+            wait_for_index(
+                indexer, uploaded_video_id, args.video_language, timeout=args.index_timeout, receiver=receiver
+            )
         )
-        time.sleep(300) # NOTE: Hack to allow indexing
-    
-    video_info = indexer.get_video_info(uploaded_video_id, video_language=args.video_language)
+        if receiver:
+            receiver.stop()
+    else:
+        video_info = get_video_insights(indexer, uploaded_video_id, video_language=args.video_language)
 
     logger.info(video_info)
 
     thumbnails = save_face_thumbnails(
-        video_info, uploaded_video_id, args.thumbnail_dir, indexer
+        video_info, uploaded_video_id, args.thumbnail_dir, indexer,
+        max_workers=args.thumbnail_workers,
+        max_thumbnails=args.max_thumbnails or None
         )
     logger.info(f"Saved thumbnails: \n{thumbnails}")
 